@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+
+'''benchmark.py - measure grabrena.py without a live EZProxy or ReNa
+
+a part of EZMenu
+@copyright: Copyright 2015 MPI for Research on Collective Goods
+@license: AGPLv3+
+
+runs the stages of grabrena.py against generated data, at several scales:
+- corpus: parse the files in eres_corpus/ with ERessourcesFile and the regex parser it replaced,
+  and compare both with the stanzas expected for each file (<name>.json next to <name>.txt)
+- parse: read a generated eResources.txt with ERessourcesFile
+- parse (regex): the same with the regex parser, see regex_stanzas()
+- transform: write_eresources() on the same file (parse, add injection code, fingerprint, write)
+- fetch: fetch_rena_collection() for a single generated collection
+- publish: a full sync_menu() into an empty js_outdir, then again with one collection changed
+
+EZProxy and ReNa are played by a local stub server (see StubHandler), which
+answers /login, /logout, Ext/PredefinedSets and the view=JSON requests for each
+set with configurable latency and failure rate. grabrena.py reaches it the way
+it reaches ReNa through EZProxy, via the (http) proxy setting of its session.
+all data is generated from fixed seeds, so runs are comparable. each stage is
+timed --repeat times without tracing, then once more under tracemalloc for the
+peak memory.
+
+usage: python3 benchmark.py [--quick] [--repeat 3] [--latency 0.02] [--failure-rate 0] [--desc-bytes 200]
+                           [--stages corpus,eresources,rena] [--json out.json]
+'''
+
+import argparse
+import collections
+import contextlib
+import http.server
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import grabrena
+
+STANZA_SCALES = [100, 1000, 10000, 50000]
+RECORD_SCALES = [10, 100, 1000, 20000]
+QUICK_STANZA_SCALES = [100, 1000]
+QUICK_RECORD_SCALES = [10, 100]
+# how many predefined sets the stub offers for the publish stage,
+# the records of the scale are spread over them ("Everything" gets all of them)
+STUB_SETS = 5
+INSTITUTE = 'BENCH'
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eres_corpus')
+
+# the regex ERessourcesFile used before it read the file line by line
+STANZA_RE = re.compile(
+    ''.join([
+        '(?P<prequel_of_stanza>(^(?!((title|url).+?\n|\n))|',
+        '(#|option|proxyhostnameedit|mimefilter|neverproxy|',
+        'anonymousurl|httpheader|cookie).+?\n)*?)',
+        '(',
+        '(^title (?P<title>.+?)$\n',
+        '(?P<misplaced_mimefilter>^mimefilter.+?$\n)?',
+        '^url (?P<url>.+?)$\n)',
+        '|',
+        '(^url (?P<url2>.+?)$\n',
+        '(?P<misplaced_mimefilter2>^mimefilter.+?$\n)?',
+        '^title (?P<title2>.+?)$\n)',
+        ')',
+        '(?P<rest_of_stanza>(^(?!title|url).+?\n)*)',
+        '(?:\n*)']),
+    re.MULTILINE | re.IGNORECASE)
+
+
+# ~~~ GENERATORS ~~~
+def generate_eresources(stanzas, seed=0):
+    '''text of an eResources.txt with the given number of stanzas
+
+mixes in the irregularities the real file has: prequel lines, MimeFilter behind Title,
+URL before Title, and a few stanzas that are not separated by an empty line'''
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(stanzas):
+        if rnd.random() < 0.3:
+            lines.append(''.join(['# ', str(i), ': comment about this resource']))
+        if rnd.random() < 0.1:
+            lines.append('Option Cookie')
+        title = ''.join(['Title Resource ', str(i), ' (', rnd.choice(['EBSCO', 'JSTOR', 'Springer', 'Wiley']), ')'])
+        url = ''.join(['URL http://www.r', str(i), '.example', str(i % 97), '.org/'])
+        if rnd.random() < 0.05:
+            lines.extend([url, title])
+        else:
+            lines.append(title)
+            if rnd.random() < 0.05:
+                lines.append('MimeFilter application/pdf .* javascript')
+            lines.append(url)
+        for j in range(rnd.randint(1, 6)):
+            lines.append(''.join([rnd.choice(['DJ', 'HJ', 'Host', 'Domain']), ' r', str(i), '-', str(j),
+                                  '.example', str(i % 97), '.org']))
+        if rnd.random() < 0.98:
+            lines.append('')
+    return ''.join([line + '\n' for line in lines])
+
+
+def generate_rena_records(count, set_index=0, seed=0, proxy_hostname='localhost', desc_bytes=200):
+    '''OrderedDict of count ReNa records, as the view=JSON response of a set has them
+
+record ids are unique per set_index, about half of the urls look proxied'''
+    rnd = random.Random(seed * 1000003 + set_index)
+    records = collections.OrderedDict()
+    for i in range(count):
+        if i % 2:
+            url = ''.join(['http://www', str(i), '.example', str(set_index), '.org.', proxy_hostname, '/x?a=', str(i)])
+        else:
+            url = ''.join(['http://www', str(i), '.example', str(set_index), '.org/'])
+        record = collections.OrderedDict()
+        record['title'] = ''.join(['Resource ', str(set_index), '-', str(i)])
+        record['genre'] = [rnd.choice(['Fulltext Database', 'Journal Collection', 'E-Books'])]
+        record['topic'] = [rnd.choice(['Multidisciplinary', 'Social Sci. + Humanities', 'Law'])]
+        record['language'] = ['English']
+        record['title_short'] = record['title']
+        record['prov_txt_mv'] = [rnd.choice(['EBSCO', 'JSTOR', 'Springer'])]
+        record['subject_txt_mv'] = [rnd.choice(['Economics', 'Law', 'Psychology'])]
+        record['naturl_str_mv'] = [url]
+        record['access_txtF'] = 'FREE' if rnd.random() < 0.4 else 'SUBSCRIPTION'
+        record['description'] = ''.join(rnd.choice('abcdefghij ') for _ in range(desc_bytes))
+        records[''.join(['ERS', str(set_index), '%08d' % i])] = record
+    return records
+
+
+# ~~~ REGEX PARSER ~~~
+def regex_stanzas(path):
+    '''yields the stanzas in path the way ERessourcesFile did with STANZA_RE, as a baseline
+
+reads the whole file at once. unlike the original, stanzas with URL before Title don't
+raise AttributeError'''
+    with open(path, 'r') as eresfile:
+        text = eresfile.read()
+    for m in STANZA_RE.finditer(text):
+        yield grabrena.EZProxyStanza(m.group('prequel_of_stanza'),
+                                     (m.group('title') or m.group('title2')).strip(),
+                                     m.group('misplaced_mimefilter') or m.group('misplaced_mimefilter2'),
+                                     (m.group('url') or m.group('url2')).strip(),
+                                     m.group('rest_of_stanza'), None)
+
+
+def stanza_fields(stanza):
+    '''what the corpus expects of a stanza'''
+    return collections.OrderedDict([('prequel', stanza.prequel), ('title', stanza.title),
+                                    ('mimefilter', stanza.mimefilter), ('url', stanza.url),
+                                    ('stanza', stanza.stanza)])
+
+
+def check_corpus(corpus_dir=CORPUS_DIR):
+    '''parses each <name>.txt in corpus_dir with both parsers and compares with <name>.json
+
+returns a list of (name, whether ERessourcesFile got it right, whether the regex parser did)'''
+    results = []
+    for filename in sorted(os.listdir(corpus_dir)):
+        if not filename.endswith('.txt'):
+            continue
+        path = os.path.join(corpus_dir, filename)
+        with open(''.join([path[:-len('.txt')], '.json']), 'r') as expectedfile:
+            expected = json.load(expectedfile, object_pairs_hook=collections.OrderedDict)
+        with grabrena.ERessourcesFile(path, 'r') as eresfile:
+            stream = [stanza_fields(stanza) for stanza in eresfile]
+        regex = [stanza_fields(stanza) for stanza in regex_stanzas(path)]
+        results.append((filename[:-len('.txt')], stream == expected, regex == expected))
+    return results
+
+
+def print_corpus(results):
+    print('{0:<24} {1:>10} {2:>10}'.format('corpus', 'stream', 'regex'))
+    for name, stream_ok, regex_ok in results:
+        print('{0:<24} {1:>10} {2:>10}'.format(name, 'ok' if stream_ok else 'DIFFERS', 'ok' if regex_ok else 'differs'))
+    print('')
+
+
+# ~~~ STUB SERVER ~~~
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    '''stands in for EZProxy and ReNa behind it, see StubServer for the settings'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b'', content_type='application/json', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        time.sleep(stub.latency)
+        self._send(302, headers=[('Set-Cookie', 'ezproxy=benchmark; Path=/'), ('Location', '/menu')],
+                   content_type='text/html')
+
+    def do_GET(self):
+        stub = self.server.stub
+        time.sleep(stub.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith('/logout') or url.path.endswith('/login'):
+            self._send(200, b'<html></html>', 'text/html')
+        elif url.path.endswith('Ext/PredefinedSets'):
+            self._send(200, stub.setlist)
+        elif url.path.endswith('Search/Results'):
+            if stub.fail():
+                self._send(503, b'', 'text/html')
+            else:
+                set_index = int(query['set'][0]) if 'set' in query else 0
+                self._send(200, stub.payload(set_index))
+        else:
+            self._send(404, b'', 'text/html')
+
+
+class StubServer(object):
+    '''a ThreadingHTTPServer with StubHandler on a free port of 127.0.0.1
+
+records are spread over STUB_SETS sets, set 0 is "Everything" and holds all of them, each record
+has a description of desc_bytes. latency is added to every request, failure_rate of the set requests
+are answered with 503'''
+
+    def __init__(self, records, latency=0.0, failure_rate=0.0, seed=0, desc_bytes=200):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.desc_bytes = desc_bytes
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._payloads = {}
+        self.records = records
+        self.seed = seed
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.setlist = json.dumps([
+            {'id': '%09d' % set_index, 'name': ''.join(['Set ', str(set_index)]), 'fullName': 'Benchmark',
+             'url': ''.join(['http://rena.mpdl.mpg.de.localhost/rena/Search/Results?set=', str(set_index)])}
+            for set_index in range(1, STUB_SETS + 1)]).encode('utf-8')
+        self._thread = None
+
+    def fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def payload(self, set_index):
+        '''response body for a set'''
+        with self._lock:
+            return self._payloads[set_index]
+
+    def _generate(self, set_index, seed):
+        '''generates the response body for a set up front, so it does not count towards the timings'''
+        if set_index == 0:
+            records = collections.OrderedDict()
+            for other_index in range(1, STUB_SETS + 1):
+                records.update(json.loads(self._payloads[other_index], object_pairs_hook=collections.OrderedDict))
+        else:
+            records = generate_rena_records(self._set_size(set_index), set_index, seed, desc_bytes=self.desc_bytes)
+        payload = json.dumps(records).encode('utf-8')
+        with self._lock:
+            self._payloads[set_index] = payload
+
+    def change(self, set_index):
+        '''let a set look different from now on, as if it had been edited on ReNa'''
+        self.seed += 1
+        self._generate(set_index, self.seed)
+        self._generate(0, self.seed)
+
+    def _set_size(self, set_index):
+        return self.records // STUB_SETS + (1 if set_index <= self.records % STUB_SETS else 0)
+
+    def __enter__(self):
+        for set_index in range(1, STUB_SETS + 1):
+            self._generate(set_index, self.seed)
+        self._generate(0, self.seed)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ~~~ MEASURING ~~~
+def measure(stage, repeat, setup=None):
+    '''runs setup() (if given, not measured) and stage() repeat times, then once more under tracemalloc
+
+returns an OrderedDict with min and median seconds and the traced peak in bytes'''
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            stage()
+            timings.append(time.perf_counter() - started)
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            stage()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return collections.OrderedDict([('min_seconds', round(min(timings), 4)),
+                                    ('median_seconds', round(statistics.median(timings), 4)),
+                                    ('peak_bytes', peak)])
+
+
+def configure(workdir, port):
+    '''an ini file for grabrena.py that writes into workdir and talks to the stub on port'''
+    config_path = os.path.join(workdir, 'grabrena.ini')
+    with open(config_path, 'w') as confh:
+        confh.write('\n'.join([
+            '[grabrena]',
+            'institute = ' + INSTITUTE,
+            'proxy_hostname = localhost',
+            'highlight1 = jstor',
+            'use_https = No',
+            'svn_up_path = ',
+            'ezproxy_executable = ',
+            'js_outdir = ' + os.path.join(workdir, 'out', ''),
+            'state_dir = ' + os.path.join(workdir, 'state', ''),
+            'precompress = gz',
+            'run_report = No',
+            # retries are part of what --failure-rate measures, but sleeping for seconds is not
+            'retry_backoff = 0.05',
+            '']))
+    grabrena.load_config(config_path)
+    # route everything through the stub, as if it was EZProxy proxying ReNa
+    proxy = ''.join(['http://127.0.0.1:', str(port)])
+    for name in ('http_proxy', 'HTTP_PROXY'):
+        os.environ[name] = proxy
+    for name in ('no_proxy', 'NO_PROXY'):
+        os.environ.pop(name, None)
+
+
+def bench_eresources(workdir, scales, repeat):
+    '''parse and transform stages, returns a list of result rows'''
+    rows = []
+    for stanzas in scales:
+        src_path = os.path.join(workdir, ''.join(['eResources.', str(stanzas), '.txt']))
+        dest_path = os.path.join(workdir, 'eResources.out.txt')
+        with open(src_path, 'w') as srcfile:
+            srcfile.write(generate_eresources(stanzas))
+
+        def parse():
+            with grabrena.ERessourcesFile(src_path, 'r') as repofile:
+                for _ in repofile:
+                    pass
+
+        def parse_regex():
+            for _ in regex_stanzas(src_path):
+                pass
+
+        def reset():
+            # otherwise write_eresources() finds nothing to do after the first time
+            for path in (dest_path, os.path.join(grabrena.grcfg['state_dir'], 'eresources_index.json')):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        rows.append(row('parse', ''.join([str(stanzas), ' stanzas']), measure(parse, repeat)))
+        result = measure(parse_regex, repeat)
+        # stanzas the two parsers don't agree on, counted outside the timings
+        with grabrena.ERessourcesFile(src_path, 'r') as repofile:
+            stream = [stanza_fields(stanza) for stanza in repofile]
+        regex = [stanza_fields(stanza) for stanza in regex_stanzas(src_path)]
+        result['mismatches'] = abs(len(stream) - len(regex)) + sum(1 for a, b in zip(stream, regex) if a != b)
+        rows.append(row('parse (regex)', ''.join([str(stanzas), ' stanzas']), result))
+        rows.append(row('transform', ''.join([str(stanzas), ' stanzas']),
+                        measure(lambda: grabrena.write_eresources(src_path, dest_path, 'https://x/inject.js'),
+                                repeat, reset)))
+    return rows
+
+
+def bench_rena(workdir, scales, repeat, latency, failure_rate, desc_bytes=200):
+    '''fetch and publish stages, each against a stub of its own. returns a list of result rows'''
+    rows = []
+    for records in scales:
+        with StubServer(records, latency, failure_rate, desc_bytes=desc_bytes) as stub:
+            configure(workdir, stub.port)
+            failures = []
+            renaset = {'id': 'Everything', 'name': 'Everything',
+                       'url': ''.join([grabrena.RENA_URL, 'Search/Results?lookfor=&type=AllFields'])}
+            session = grabrena.new_session()
+
+            def fetch():
+                try:
+                    grabrena.fetch_rena_collection(session, renaset)
+                except Exception as e:
+                    failures.append(e)
+
+            result = measure(fetch, repeat)
+            result['failures'] = len(failures)
+            rows.append(row('fetch', ''.join([str(records), ' records']), result))
+
+            def clean():
+                for name in ('out', 'state'):
+                    shutil.rmtree(os.path.join(workdir, name), ignore_errors=True)
+                os.makedirs(os.path.join(workdir, 'out'))
+
+            def publish():
+                try:
+                    grabrena.sync_menu(session)
+                except Exception as e:
+                    failures.append(e)
+
+            def change():
+                clean()
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    publish()
+                stub.change(1)
+
+            failures.clear()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                grabrena.login(session)
+            result = measure(publish, repeat, clean)
+            result['failures'] = len(failures)
+            rows.append(row('publish (cold)', ''.join([str(records), ' records']), result))
+            failures.clear()
+            result = measure(publish, repeat, change)
+            result['failures'] = len(failures)
+            rows.append(row('publish (1 set changed)', ''.join([str(records), ' records']), result))
+            session.close()
+    return rows
+
+
+def row(stage, scale, result):
+    entry = collections.OrderedDict([('stage', stage), ('scale', scale)])
+    entry.update(result)
+    return entry
+
+
+def print_rows(rows):
+    print('{0:<24} {1:>16} {2:>10} {3:>10} {4:>10} {5:>8} {6:>10}'.format(
+        'stage', 'scale', 'min s', 'median s', 'peak MB', 'failed', 'mismatch'))
+    for entry in rows:
+        print('{0:<24} {1:>16} {2:>10.4f} {3:>10.4f} {4:>10.2f} {5:>8} {6:>10}'.format(
+            entry['stage'], entry['scale'], entry['min_seconds'], entry['median_seconds'],
+            entry['peak_bytes'] / 1e6, entry.get('failures', ''), entry.get('mismatches', '')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='measure grabrena.py against generated data and a stub server')
+    parser.add_argument('--quick', action='store_true', help='only the smaller scales')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage and scale (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the stub waits before each answer (default: %(default)s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='share of collection requests the stub answers with 503 (default: %(default)s)')
+    parser.add_argument('--desc-bytes', type=int, default=200,
+                        help='length of the description of each generated ReNa record (default: %(default)s)')
+    parser.add_argument('--stages', default='corpus,eresources,rena',
+                        help='"corpus", "eresources" (parse, transform) and/or "rena" (fetch, publish)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+    stages = args.stages.split(',')
+    rows = []
+    corpus = check_corpus() if 'corpus' in stages else []
+    workdir = tempfile.mkdtemp(prefix='grabrena-benchmark-')
+    try:
+        if 'eresources' in stages:
+            configure(workdir, 0)
+            rows.extend(bench_eresources(workdir, QUICK_STANZA_SCALES if args.quick else STANZA_SCALES, args.repeat))
+        if 'rena' in stages:
+            rows.extend(bench_rena(workdir, QUICK_RECORD_SCALES if args.quick else RECORD_SCALES, args.repeat,
+                                   args.latency, args.failure_rate, args.desc_bytes))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if corpus:
+        print_corpus(corpus)
+    print_rows(rows)
+    if args.json:
+        with open(args.json, 'w') as jsonfile:
+            json.dump({'args': vars(args), 'corpus': [collections.OrderedDict(
+                [('name', name), ('stream', stream_ok), ('regex', regex_ok)]) for name, stream_ok, regex_ok in corpus],
+                'results': rows}, jsonfile, indent=2)
+    # the regex parser is only a baseline, but ERessourcesFile has to parse the corpus as expected
+    if not all(stream_ok for name, stream_ok, regex_ok in corpus):
+        raise SystemExit('ERessourcesFile does not parse all of the corpus as expected')
+
+
+if __name__ == '__main__':
+    main()
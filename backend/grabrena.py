@@ -19,6 +19,15 @@ running and up to date. this script attempts to do the following things:
   where it can be served by the internal webserver of EZProxy
 - write a small (JSON) index of the collections and when each was last updated
 - log out of EZProxy
+
+run with --daemon to keep running and do this every daemon_interval seconds
+(or on SIGUSR1) with the same EZProxy session. with [target ...] sections in the
+ini file, one run does all of them, see run_targets(). importing this module has no
+side effects, call load_config() before using any of the stages:
+svn_update(), install_eresources(), restart_if_needed(), new_session()/login(),
+prepare_sync(), fetch_setlist(), sync_collections(), publish() and logout().
+sync_menu() runs them (all but new_session() and logout()) in a PhaseScheduler,
+overlapping the ones that don't depend on each other
 '''
 
 # TODO(krugar): the account used to login should only have access to ReNa
@@ -28,20 +37,43 @@ running and up to date. this script attempts to do the following things:
 # TODO(krugar): write a nice error handling routine that catches our
 # custom errors and dies gracefully or writes an email if the error is critical
 
+import argparse
+import codecs
 import collections
+from concurrent.futures import CancelledError
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 import configparser
+import contextlib
+import cProfile
+import gzip
 import hashlib
-# import io
+import io
 import json
 import os
+import random
 import re
 import requests
+import shutil
+import signal
+import socket
 import subprocess
 # import sys
+import threading
 import time
+import tracemalloc
+import unicodedata
+from urllib.parse import quote
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
+try:  # optional, only needed to write precompressed .br files
+    import brotli
+except ImportError:
+    brotli = None
+
 # example of expected json data format incoming from ReNa:
 # getSets({
 #   "ERS000000318":{
@@ -75,6 +107,20 @@ from urllib.parse import urlunparse
 # });
 
 
+CANONICAL_JSON = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+MINIFIED_JSON = json.JSONEncoder(separators=(',', ':'))
+# ReNa responses are parsed in chunks of this many bytes, see RenaRecordStream
+RENA_CHUNK_SIZE = 64 * 1024
+# subdirectory of js_outdir where files are written before they go live, see commit_output()
+STAGING_DIR = '.staging'
+# write order of the precompressed variants of an output file, the .json itself comes last
+OUTPUT_EXTENSIONS = ('.gz', '.br', '')
+# share of values in the facet table that no entry uses any more at which the next run rebuilds it
+FACET_COMPACT_SHARE = 0.5
+# what makes a term of the search index, after search_terms() folded case and diacritics
+SEARCH_TERM_RE = re.compile(r'[^\W_]+')
+
+
 # ~~~ CLASSES  ~~~
 # ~~~ EXCEPTIONS  ~~~
 class GrabrenaError(Exception):
@@ -98,6 +144,16 @@ class LoginError(GrabrenaError):
     pass
 
 
+class RestartError(GrabrenaError):
+    '''EZProxy did not come back up after a restart'''
+    pass
+
+
+class ErrorBudgetError(GrabrenaError):
+    '''more collections failed than error_budget allows'''
+    pass
+
+
 # ~~~ OTHER CLASSES  ~~~
 class EZProxyStanza(object):
     def __init__(self, prequel, title, mimefilter, url, other_lines, *script_filename):
@@ -157,50 +213,98 @@ we're expecting Database Stanzas of the following format:
     URL <Something we simply assume is a valid URL>
     <multiple non-empty lines not starting with 'Title' or 'URL'>
 
-our RE parses the portions denoted by <> above into named groups
-even if Title and URL appear in reverse order. they need to be the first
-two lines of a stanza, however. Case is irrelevant
+the file is read line by line, and the portions denoted by <> above are
+picked up even if Title and URL appear in reverse order. they need to be the
+first two lines of a stanza, however. Case is irrelevant
 
 file/open wrapper code from http://stackoverflow.com/a/14095585
 by http://stackoverflow.com/users/4279/j-f-sebastian
 '''
 
+    # stanzas usually start with one or more comment lines
+    # followed by a limited list of commands that need to go before
+    PREQUEL_RE = re.compile('(#|option|proxyhostnameedit|mimefilter|neverproxy|'
+                            'anonymousurl|httpheader|cookie).', re.IGNORECASE)
+    # the required title and url lines, which can come in reverse
+    HEADER_RE = re.compile('(?P<keyword>title|url) (?P<value>.+)', re.IGNORECASE)
+    # also, the MPDL likes to put mimefilter directly behind title
+    MIMEFILTER_RE = re.compile('mimefilter.', re.IGNORECASE)
+
     def __init__(self, file, *args, **kwargs):
         self.close_file = kwargs.pop('close', True)
         # accept either filename or file-like object
         self.file = file if hasattr(file, 'read') else open(file, *args, **kwargs)
 
         # initialize iterator stuff
-        r = re.compile(
-            ''.join([
-                # stanzas usually start with one or more comment lines
-                # followed by a limited list of commands that need to go before
-                '(?P<prequel_of_stanza>(^(?!((title|url).+?\n|\n))|',
-                '(#|option|proxyhostnameedit|mimefilter|neverproxy|',
-                'anonymousurl|httpheader|cookie).+?\n)*?)',
-                # the required title and url lines, which can come in reverse
-                '(',
-                '(^title (?P<title>.+?)$\n',
-                # also, the MPDL likes to put mimefilter directly behind title
-                '(?P<misplaced_mimefilter>^mimefilter.+?$\n)?',
-                '^url (?P<url>.+?)$\n)',
-                '|',  # check for the the reverse case
-                '(^url (?P<url2>.+?)$\n',
-                '(?P<misplaced_mimefilter2>^mimefilter.+?$\n)?',
-                '^title (?P<title2>.+?)$\n)',
-                ')',
-                # the rest of the stanza is not properly defined here
-                # aside from the requirement that it cannot run over
-                # the next Title or URL line
-                '(?P<rest_of_stanza>(^(?!title|url).+?\n)*)',
-                # we cling to the hope that it is terminated by an empty line.
-                # this is convention only, tho :S
-                # however, since the sequence of stanzas is preserved,
-                # there is a certain chance that parsing errors will be of
-                # limited consequence. (probably menu injection will fail)
-                '(?:\n*)']),
-            re.MULTILINE | re.IGNORECASE)
-        self._iterator = r.finditer(self.file.read())  # iterate over RE matches
+        self._pending = collections.deque()  # lines to look at again after a stanza failed to parse
+        self._iterator = self._stanzas()
+
+    def _lines(self):
+        '''yields lines from the file, each with a closing \\n'''
+        file_iterator = iter(self.file)
+        while True:
+            if self._pending:
+                yield self._pending.popleft()
+                continue
+            line = next(file_iterator, None)
+            if line is None:
+                return
+            yield line if line.endswith('\n') else ''.join([line, '\n'])
+
+    def _header(self, line):
+        '''returns (keyword, value) if line is a Title or URL line, None otherwise'''
+        m = self.HEADER_RE.match(line)
+        if m is None:
+            return None
+        return m.group('keyword').lower(), m.group('value')
+
+    def _stanzas(self):
+        '''generator that reads the file and yields EZProxyStanza objects
+
+only the stanza currently being parsed is kept in memory'''
+        lines = self._lines()
+        prequel = []
+        for line in lines:
+            first = self._header(line)
+            if first is None:
+                if self.PREQUEL_RE.match(line):
+                    prequel.append(line)
+                else:
+                    # empty lines and anything we don't understand end the prequel
+                    prequel = []
+                continue
+            mimefilter = None
+            second_line = next(lines, None)
+            if second_line is not None and self.MIMEFILTER_RE.match(second_line):
+                mimefilter = second_line
+                second_line = next(lines, None)
+            second = self._header(second_line) if second_line is not None else None
+            if second is None or second[0] == first[0]:
+                # no Title/URL pair. drop what we have and start over behind the first header line
+                prequel = []
+                self._pending.extend(x for x in (mimefilter, second_line) if x is not None)
+                continue
+            # the rest of the stanza is not properly defined here
+            # aside from the requirement that it cannot run over
+            # the next Title or URL line
+            rest_of_stanza = []
+            for line in lines:
+                if line == '\n':
+                    # we cling to the hope that it is terminated by an empty line.
+                    # this is convention only, tho :S
+                    # however, since the sequence of stanzas is preserved,
+                    # there is a certain chance that parsing errors will be of
+                    # limited consequence. (probably menu injection will fail)
+                    break
+                if line[:5].lower() == 'title' or line[:3].lower() == 'url':
+                    self._pending.append(line)
+                    break
+                rest_of_stanza.append(line)
+            # .strip() to remove trailing whitespace for fields w/o newline
+            headers = dict([first, second])
+            yield EZProxyStanza(''.join(prequel), headers['title'].strip(), mimefilter,
+                                headers['url'].strip(), ''.join(rest_of_stanza), None)
+            prequel = []
 
     # context manager support
     def __enter__(self):
@@ -223,14 +327,7 @@ by http://stackoverflow.com/users/4279/j-f-sebastian
         return self
 
     def __next__(self):
-        m = self._iterator.__next__()
-        # .strip() to remove trailing whitespace for fields w/o newline
-        this_prequel = m.group('prequel_of_stanza')
-        this_title = m.group('title').strip() or m.group('title2').strip()
-        this_mimefilter = m.group('misplaced_mimefilter') or m.group('misplaced_mimefilter2')
-        this_url = m.group('url').strip() or m.group('url2').strip()
-        this_stanza = m.group('rest_of_stanza')
-        return EZProxyStanza(this_prequel, this_title, this_mimefilter, this_url, this_stanza, None)
+        return self._iterator.__next__()
 
     next = __next__  # Python 2 support
 
@@ -239,22 +336,1137 @@ by http://stackoverflow.com/users/4279/j-f-sebastian
         return getattr(self.file, attr)
 
 
+class HostIndex(object):
+    '''which hosts EZProxy proxies, according to the URL, Host and Domain lines of its stanzas
+
+built once per eResources.txt, then classify() tells for each URL with a single parse and
+a few set lookups whether it is proxied, whether a stanza would proxy it if it was and
+whether it is on one of the highlight hosts'''
+
+    # the lines of a stanza that name hosts: H/HJ/Host/HostJavaScript for exactly that host,
+    # D/DJ/Domain/DomainJavaScript for the host and all its subdomains
+    HOST_RE = re.compile(r'^\s*(?P<keyword>hj|h|hostjavascript|host|dj|d|domainjavascript|domain)\s+(?P<value>.+)$',
+                         re.IGNORECASE | re.MULTILINE)
+    # scheme, optional user info, host (with brackets if it is an IPv6 address)
+    URL_HOST_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^/?#@]*@)?(?P<host>\[[^\]/?#]*\]|[^:/?#]*)')
+
+    def __init__(self, proxy_hostname, highlight=''):
+        self.proxy_hostname = proxy_hostname.lower()
+        self.hosts = set()
+        self.domains = set()
+        self.proxy_suffix = ''.join(['.', self.proxy_hostname])
+        self.highlights = set(host.strip().lower() for host in highlight.split(';') if host.strip() != '')
+        # highlights like "jstor" match any host with such a label
+        self.highlight_labels = set(host for host in self.highlights if '.' not in host)
+        # what the index was built from, see load_host_index()
+        self.source = None
+
+    @staticmethod
+    def hostname(value):
+        '''the lowercase host of value, which can be a URL, host:port or just a host'''
+        # options like -Form=... come before the URL or host
+        value = value.split()[-1] if value.strip() != '' else ''
+        if '://' in value:
+            try:
+                return (urlparse(value).hostname or '').lower()
+            except ValueError:
+                return ''
+        return value.split('/')[0].split(':')[0].strip('.').lower()
+
+    def add_stanza(self, stanza):
+        self.hosts.add(self.hostname(stanza.url))
+        for m in self.HOST_RE.finditer(stanza.stanza):
+            host = self.hostname(m.group('value'))
+            if m.group('keyword').lower().startswith('d'):
+                self.domains.add(host)
+            else:
+                self.hosts.add(host)
+        self.hosts.discard('')
+        self.domains.discard('')
+
+    def fingerprint(self):
+        '''a hash of everything classify() goes by, to tell whether entries were classified with the same index'''
+        parts = [self.proxy_hostname, ';'.join(sorted(self.hosts)), ';'.join(sorted(self.domains)),
+                 ';'.join(sorted(self.highlights))]
+        return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def in_domains(host, domains):
+        '''whether host or one of its parent domains is in domains'''
+        while True:
+            if host in domains:
+                return True
+            dot = host.find('.')
+            if dot < 0:
+                return False
+            host = host[dot + 1:]
+
+    def highlighted(self, host):
+        '''whether host is, or is below, one of the highlight hosts, or has one of them as a label'''
+        if self.in_domains(host, self.highlights):
+            return True
+        return len(self.highlight_labels) > 0 and not self.highlight_labels.isdisjoint(host.split('.'))
+
+    def classify(self, url):
+        '''returns (proxied, covered, highlight) for url. covered means a stanza exists for the host of
+an unproxied url, so it could have been proxied'''
+        m = self.URL_HOST_RE.match(url)
+        host = m.group('host').lower() if m is not None else ''
+        proxied = host == self.proxy_hostname or host.endswith(self.proxy_suffix)
+        covered = False
+        if proxied:
+            # proxy by hostname: www.jstor.org.<proxy_hostname>, or www-jstor-org.<proxy_hostname>
+            origin = host[:-len(self.proxy_suffix)] if host != self.proxy_hostname else ''
+            highlight = self.highlighted(origin) or ('-' in origin and self.highlighted(origin.replace('-', '.')))
+        else:
+            covered = host in self.hosts or self.in_domains(host, self.domains)
+            highlight = self.highlighted(host)
+        return proxied, covered, highlight
+
+
+class RenaRecordStream(object):
+    '''provides iterator access to the records in a ReNa collection response
+
+ReNa answers with a single JSON object that maps record ids to records:
+
+    {"ERS000000318": {"title": ...}, "ERS000000319": {...}, ...}
+
+instead of decoding all of it at once, this yields (record id, record) pairs
+decoded from chunks of the response body as they arrive, so only the current
+chunk and record need to be held in memory, no matter the size of the response.
+raises ValueError on malformed JSON, just like json.loads() would'''
+
+    WHITESPACE_RE = re.compile(r'\s*')
+
+    def __init__(self, chunks, encoding=None):
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder(encoding or 'utf-8')()
+        self._json_decoder = json.JSONDecoder(object_pairs_hook=collections.OrderedDict)
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+        self._iterator = self._records()
+        self.size = 0  # bytes received so far
+        self.waited = 0.0  # seconds spent waiting for chunks
+
+    def _more(self):
+        '''appends the next chunk to the buffer, dropping what has been decoded. False if there is none'''
+        if self._exhausted:
+            return False
+        started = time.monotonic()
+        chunk = next(self._chunks, None)
+        self.waited += time.monotonic() - started
+        if chunk is None:
+            self._exhausted = True
+            text = self._text_decoder.decode(b'', final=True)
+        else:
+            self.size += len(chunk)
+            text = self._text_decoder.decode(chunk)
+        self._buffer = ''.join([self._buffer[self._pos:], text])
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        '''skips whitespace, returns the next character or '' at the end of the response'''
+        while True:
+            self._pos = self.WHITESPACE_RE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._more():
+                return ''
+
+    def _expect(self, chars):
+        '''consumes the next character, which has to be one of chars'''
+        char = self._peek()
+        if char == '' or char not in chars:
+            raise ValueError(''.join(['ReNa response: expected one of "', chars, '", got "', char,
+                                      '" at ', str(self._pos)]))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        '''decodes the JSON value at the current position'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # most likely, the value continues in the next chunk
+                if not self._more():
+                    raise
+                continue
+            if end == len(self._buffer) and self._more():
+                # numbers and literals could continue in the next chunk, too
+                continue
+            self._pos = end
+            return value
+
+    def _records(self):
+        if self._expect('{[') == '[':
+            # ReNa sends an empty array for empty collections
+            self._expect(']')
+        elif self._peek() == '}':
+            self._pos += 1
+        else:
+            while True:
+                record_id = self._value()
+                if not isinstance(record_id, str):
+                    raise ValueError(''.join(['ReNa response: record id is not a string: ', str(record_id)]))
+                self._expect(':')
+                yield record_id, self._value()
+                if self._expect(',}') == '}':
+                    break
+        if self._peek() != '':
+            raise ValueError(''.join(['ReNa response: extra data at ', str(self._pos)]))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._iterator.__next__()
+
+
+class ResourceTable(object):
+    '''entries shared by all collections, keyed by ReNa record id
+
+with a resource table, collection files only carry 'refs', an ordered list of keys
+into the table, instead of repeating the same entries in every collection.
+the table is read from its file (js_outdir/<name>.json) only once it is needed'''
+
+    def __init__(self, name=None):
+        self.name = name  # the file this table was read from / last written to
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = collections.OrderedDict()
+            if self.name is not None:
+                try:
+                    with open(output_path(self.name), 'r') as tablefile:
+                        self._entries = json.load(tablefile, object_pairs_hook=collections.OrderedDict)['entries']
+                except (OSError, ValueError, KeyError):
+                    print(''.join(['\tCould not read resource table ', self.name, ', starting a new one']))
+        return self._entries
+
+    def add(self, record_id, entry):
+        '''put entry into the table, returns the key it can be found under'''
+        key = record_id
+        dupe_count = 1
+        # the same record can differ between collections (e.g. if it changed in between requests)
+        while key in self.entries and self.entries[key] != entry:
+            dupe_count += 1
+            key = ''.join([record_id, '~', str(dupe_count)])
+        self.entries[key] = entry
+        return key
+
+    def resolve(self, refs):
+        '''list of the entries refs point to, raises KeyError for unknown refs'''
+        return [self.entries[ref] for ref in refs]
+
+    def prune(self, referenced):
+        '''drop all entries with keys not in referenced'''
+        self._entries = collections.OrderedDict(
+            (key, entry) for key, entry in self.entries.items() if key in referenced)
+
+    def write(self):
+        '''write the table to a file named after a hash of its content, returns the bytes written'''
+        entries_raw = MINIFIED_JSON.encode(self.entries).encode('utf-8')
+        # always hashed, the name doubles as version of the table in browser storage
+        self.name = '.'.join(['resources', hashlib.sha256(entries_raw).hexdigest()[:12]])
+        return write_output(self.name, collections.OrderedDict([('file', self.name), ('entries', self.entries)]))
+
+
+class FacetTable(object):
+    '''string tables for the facet_fields of entries, so entries carry small integer indexes
+instead of repeating the same strings in every collection
+
+values are only appended, an index means the same value for as long as the table exists.
+entries (and their digests and patches) don't change when other collections bring in new values.
+values no entry uses any more stay, until rebuild() starts over with an empty table (see unused()).
+the table is read from its file (js_outdir/<name>.json) only once it is needed, lost is set if
+that failed or the table is rebuilt, collections encoded with the old table then need to be
+written again. generation counts these new starts, collections remember the one they were encoded in'''
+
+    def __init__(self, name=None, generation=0):
+        self.name = name  # the file this table was read from / last written to
+        self.generation = generation
+        self.changed = False
+        self.lost = False
+        self._values = None
+        self._indexes = None
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = collections.OrderedDict()
+            if self.name is not None:
+                try:
+                    with open(output_path(self.name), 'r') as tablefile:
+                        self._values = json.load(tablefile, object_pairs_hook=collections.OrderedDict)['values']
+                except (OSError, ValueError, KeyError):
+                    print(''.join(['\tCould not read facet table ', self.name, ', starting a new one']))
+                    self.lost = True
+                    self.generation += 1
+            self._indexes = dict((field, dict((value, index) for index, value in enumerate(field_values)))
+                                 for field, field_values in self._values.items())
+        return self._values
+
+    def encode(self, entry):
+        '''a copy of entry with the values in its 'facets' replaced by their indexes'''
+        if 'facets' not in entry:
+            return entry
+        encoded = collections.OrderedDict(entry)
+        encoded['facets'] = collections.OrderedDict()
+        for field, field_values in entry['facets'].items():
+            table = self.values.setdefault(field, [])
+            indexes = self._indexes.setdefault(field, {})
+            for value in field_values:
+                if value not in indexes:
+                    indexes[value] = len(table)
+                    table.append(value)
+                    self.changed = True
+            encoded['facets'][field] = [indexes[value] for value in field_values]
+        return encoded
+
+    def unused(self, entries):
+        '''how many values of the table none of entries (encoded ones) refer to'''
+        used = collections.defaultdict(set)
+        for entry in entries:
+            for field, indexes in entry.get('facets', {}).items():
+                used[field].update(indexes)
+        return sum(len(field_values) - len(used[field]) for field, field_values in self.values.items())
+
+    def rebuild(self):
+        '''start over with an empty table, all collections get encoded again (see lost)'''
+        self._values = collections.OrderedDict()
+        self._indexes = {}
+        self.lost = True
+        self.changed = True
+        self.generation += 1
+
+    def write(self):
+        '''write the table to a file named after a hash of its content, returns the bytes written'''
+        values_raw = MINIFIED_JSON.encode(self.values).encode('utf-8')
+        self.name = '.'.join(['facets', hashlib.sha256(values_raw).hexdigest()[:12]])
+        self.changed = False
+        return write_output(self.name, collections.OrderedDict([('file', self.name), ('values', self.values)]))
+
+
+class RunMetrics(object):
+    '''timings and counts of one run, see write_metrics()
+
+phases (svn, login, collections, ...) are timed with phase(), per collection values go
+into the dict collection(id) returns, everything else that is worth a number into gauges'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.duration = None
+        self.success = False
+        self.phases = collections.OrderedDict()
+        self.collections = collections.OrderedDict()
+        self.gauges = collections.OrderedDict()
+        self.files_written = 0
+        self.bytes_written = 0
+        self.files_skipped = []
+        # (phase, seconds) of the phases that determined the wall time, see PhaseScheduler
+        self.critical_path = []
+        self.profiler = None
+        self.tracing = False
+        self._clock = time.monotonic()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def timed(target, key):
+        '''adds the seconds spent in the with block to target[key]'''
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            target[key] = target.get(key, 0.0) + time.monotonic() - started
+
+    def phase(self, name):
+        return self.timed(self.phases, name)
+
+    def collection(self, set_id):
+        return self.collections.setdefault(set_id, collections.OrderedDict())
+
+    def file_written(self, raw):
+        self.files_written += 1
+        self.bytes_written += len(raw)
+
+    def file_skipped(self, name):
+        self.files_skipped.append(name)
+
+    def start(self, profile=()):
+        '''start the profilers named in profile ("cprofile", "tracemalloc")'''
+        if 'cprofile' in profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if 'tracemalloc' in profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def stop(self, success):
+        '''end of the run. stops profiling, returns the tracemalloc snapshot if there is one'''
+        self.success = success
+        self.duration = time.monotonic() - self._clock
+        snapshot = None
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            self.gauges['peak_traced_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return snapshot
+
+    def report(self):
+        '''everything as an OrderedDict, for the JSON run report'''
+        return collections.OrderedDict([
+            ('started', int(self.started)),
+            ('seconds', round(self.duration or 0.0, 3)),
+            ('success', self.success),
+            ('phases', collections.OrderedDict((name, round(value, 3)) for name, value in self.phases.items())),
+            ('critical_path', [[name, round(value, 3)] for name, value in self.critical_path]),
+            ('collections', self.collections),
+            ('gauges', self.gauges),
+            ('files_written', self.files_written),
+            ('bytes_written', self.bytes_written),
+            ('files_skipped', self.files_skipped)])
+
+    def prometheus(self):
+        '''everything in the text format of the Prometheus node exporter's textfile collector'''
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(''.join(['# HELP grabrena_', name, ' ', help_text]))
+            lines.append(''.join(['# TYPE grabrena_', name, ' gauge']))
+            for labels, value in samples:
+                label_text = ','.join(''.join([key, '="', str(label).replace('\\', '\\\\').replace('"', '\\"')
+                                               .replace('\n', '\\n'), '"']) for key, label in labels)
+                lines.append(''.join(['grabrena_', name, '{' + label_text + '}' if label_text else '',
+                                      ' ', repr(float(value))]))
+
+        metric('last_run_timestamp_seconds', 'When the last run started', [((), self.started)])
+        metric('last_run_success', 'Whether the last run finished without errors', [((), int(self.success))])
+        metric('run_seconds', 'Wall time of the last run', [((), self.duration or 0.0)])
+        metric('phase_seconds', 'Wall time per phase of the last run',
+               [((('phase', name),), value) for name, value in self.phases.items()])
+        for key, help_text in (('fetch_seconds', 'Wall time to request and parse a collection from ReNa'),
+                               ('network_seconds', 'Part of fetch_seconds spent waiting for the response body'),
+                               ('hash_seconds', 'Wall time to compute the digest of a collection'),
+                               ('write_seconds', 'Wall time to write a collection and its patch'),
+                               ('bytes', 'Size of the ReNa response for a collection'),
+                               ('entries', 'Entries in a collection'),
+                               ('proxied', 'Entries in a collection with proxied URLs'),
+                               ('covered', 'Entries in a collection we proxied because ReNa had them unproxied'),
+                               ('unproxied', 'Entries in a collection with URLs that are not proxied'),
+                               ('not_proxied_not_free', 'Entries in a collection that are neither proxied nor free')):
+            samples = [((('collection', set_id),), stats[key])
+                       for set_id, stats in self.collections.items() if key in stats]
+            if len(samples) > 0:
+                metric(''.join(['collection_', key]), help_text, samples)
+        for name, value in self.gauges.items():
+            metric(name, name.replace('_', ' '), [((), value)])
+        metric('files_written', 'Files written by the last run (precompressed variants not counted)',
+               [((), self.files_written)])
+        metric('bytes_written', 'Bytes written by the last run (precompressed variants not counted)',
+               [((), self.bytes_written)])
+        metric('files_skipped', 'Files the last run did not need to write', [((), len(self.files_skipped))])
+        return ''.join([line + '\n' for line in lines])
+
+
+class PhaseScheduler(object):
+    '''runs the phases of a run, each as soon as the phases it depends on are done
+
+phases added with background=True run in threads of their own, the others one after the other
+in the calling thread, where cProfile sees them. each phase is called with a dict holding the
+results of the phases done so far, and timed into metrics.phases'''
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.results = {}
+        # (started, finished) per phase, in seconds since run() was called
+        self.spans = {}
+
+    def add(self, name, func, after=(), background=False, waits=()):
+        '''phases can only depend on phases added before them
+
+a phase fails without being run if one of the phases in after failed. the ones in waits
+only need to be over, no matter how'''
+        for dependency in tuple(after) + tuple(waits):
+            if dependency not in self.phases:
+                raise ValueError(''.join(['phase ', name, ' depends on unknown phase ', dependency]))
+        self.phases[name] = (func, tuple(after), background, tuple(waits))
+
+    def _run_phase(self, name, futures, clock):
+        func, after, background, waits = self.phases[name]
+        try:
+            wait([futures[dependency] for dependency in waits])
+            for dependency in after:
+                # raises if the dependency failed, so this one fails as well
+                futures[dependency].result()
+            started = time.monotonic()
+            with metrics.phase(name):
+                result = func(self.results)
+            self.spans[name] = (started - clock, time.monotonic() - clock)
+            self.results[name] = result
+            futures[name].set_result(result)
+        except BaseException as e:
+            futures[name].set_exception(e)
+
+    def run(self):
+        '''run all phases, returns their results by name
+
+if phases failed, the error of the first one is raised once the others are done'''
+        clock = time.monotonic()
+        futures = dict((name, Future()) for name in self.phases)
+        background = [name for name, phase in self.phases.items() if phase[2]]
+        with ThreadPoolExecutor(max_workers=max(1, len(background))) as pool:
+            for name in background:
+                pool.submit(self._run_phase, name, futures, clock)
+            for name, phase in self.phases.items():
+                if not phase[2]:
+                    self._run_phase(name, futures, clock)
+        for name in self.phases:
+            if futures[name].exception() is not None:
+                raise futures[name].exception()
+        return self.results
+
+    def critical_path(self):
+        '''(phase, seconds) of the chain of phases each waiting for the one before it, which ended last
+
+a phase waits for its dependencies and, if it runs in the calling thread, for the phase that ran there
+before it. the phases on this path are the ones worth making faster'''
+        waits_for = {}
+        previous = None
+        for name, (func, after, background, waits) in self.phases.items():
+            waits_for[name] = list(after + waits)
+            if not background:
+                if previous is not None:
+                    waits_for[name].append(previous)
+                previous = name
+        path = []
+        candidates = list(self.spans)
+        while len(candidates) > 0:
+            name = max(candidates, key=lambda candidate: self.spans[candidate][1])
+            path.append((name, self.spans[name][1] - self.spans[name][0]))
+            candidates = [dependency for dependency in waits_for[name] if dependency in self.spans]
+        path.reverse()
+        return path
+
+
 # ~~~ FUNCTIONS ~~~
+def collection_entries(collection, table):
+    '''the entries of a collection read from one of our files, resolving refs if there are any'''
+    if 'refs' in collection:
+        return table.resolve(collection['refs'])
+    return collection['data']
+
+
+def delta_key(entry):
+    '''what identifies entries in collection_delta(): urls for entries, the ref itself for refs'''
+    return entry if isinstance(entry, str) else entry['url']
+
+
 def json_hexdigest(data):
-    '''creates a sha hash of the json representation of an object'''
+    '''creates a sha hash of the canonical json representation of an object
+
+keys are sorted and separators are fixed, so dict ordering does not matter.
+lists are fed into the hash item by item instead of as one big string'''
     newsha = hashlib.sha256()
     # TODO(krugar): find a way to do this without the extra encode('utf-8')
-    newsha.update(json.dumps(data).encode('utf-8'))
+    if isinstance(data, list):
+        newsha.update(b'[')
+        for index, item in enumerate(data):
+            if index > 0:
+                newsha.update(b',')
+            newsha.update(CANONICAL_JSON.encode(item).encode('utf-8'))
+        newsha.update(b']')
+    else:
+        newsha.update(CANONICAL_JSON.encode(data).encode('utf-8'))
     return newsha.hexdigest()
 
 
-def good_rena_entries_to_array(entries):
-    '''copy good items from ReNa JSON response obj into array, discard dict keys'''
+def file_hexdigest(path):
+    '''creates a sha hash of a file's content, None if there is no such file'''
+    newsha = hashlib.sha256()
+    try:
+        with open(path, 'rb') as hashfile:
+            for chunk in iter(lambda: hashfile.read(65536), b''):
+                newsha.update(chunk)
+    except OSError:
+        return None
+    return newsha.hexdigest()
+
+
+def output_path(name, extension='', staged=False):
+    '''path of the file js_outdir/<name>.json, extension is added after .json
+
+with staged, the path in the staging directory instead, see write_output()'''
+    if staged:
+        return os.path.join(grcfg['js_outdir'], STAGING_DIR, ''.join([name, '.json', extension]))
+    return ''.join([grcfg['js_outdir'], name, '.json', extension])
+
+
+def write_staged(name, extension, raw):
+    '''write raw to the staged path of js_outdir/<name>.json<extension> and make sure it is on disk'''
+    with open(output_path(name, extension, staged=True), 'wb') as out:
+        out.write(raw)
+        out.flush()
+        os.fsync(out.fileno())
+
+
+def write_output(name, data):
+    '''write data as minified JSON to js_outdir/<name>.json, plus precompressed variants if configured
+
+the files only go live with commit_output(), until then browsers keep getting the old ones and
+output_path(name) still is the old version. data can also be given as already encoded bytes.
+returns the bytes written to the .json file'''
+    raw = data if isinstance(data, bytes) else MINIFIED_JSON.encode(data).encode('utf-8')
+    os.makedirs(os.path.join(grcfg['js_outdir'], STAGING_DIR), exist_ok=True)
+    write_staged(name, '', raw)
+    metrics.file_written(raw)
+    for extension in grcfg['precompress'].split(';'):
+        if extension == 'gz':
+            write_staged(name, '.gz', gzip.compress(raw, 9, mtime=0))
+        elif extension == 'br' and brotli is not None:
+            write_staged(name, '.br', brotli.compress(raw))
+    if name not in staged_output:
+        staged_output.append(name)
+    return raw
+
+
+def remove_output(name):
+    '''remove js_outdir/<name>.json and its precompressed variants, if present'''
+    for extension in OUTPUT_EXTENSIONS:
+        try:
+            os.remove(output_path(name, extension))
+        except FileNotFoundError:
+            pass
+
+
+def retire_output(name):
+    '''have js_outdir/<name>.json removed once it has been out of use for retire_grace seconds
+
+browsers that got the setlist just before this run replaced it may still ask for the file'''
+    if name not in retired_output:
+        retired_output.append(name)
+
+
+def discard_output():
+    '''forget about files written or retired since the last commit_output(), e.g. by a run that failed'''
+    del staged_output[:]
+    del retired_output[:]
+    shutil.rmtree(os.path.join(grcfg['js_outdir'], STAGING_DIR), ignore_errors=True)
+
+
+def commit_output(last=('setlist', 'menupack')):
+    '''move the files written since the last commit from the staging directory into js_outdir
+
+each file is replaced in one step with os.replace(), so browsers never get half a file.
+the ones named in last go live after all others, so that by the time a browser learns about
+a new collection file or resource table from them, it is there. then the files retired in
+this run are noted in state_dir, and the ones that have been retired for longer than
+retire_grace seconds are removed'''
+    staged_names = [name for name in staged_output if name not in last]
+    staged_names.extend(name for name in last if name in staged_output)
+    for name in staged_names:
+        for extension in OUTPUT_EXTENSIONS:
+            if os.path.exists(output_path(name, extension, staged=True)):
+                os.replace(output_path(name, extension, staged=True), output_path(name, extension))
+            elif extension != '':
+                # the variant of an older version would be served instead of the new .json
+                try:
+                    os.remove(output_path(name, extension))
+                except FileNotFoundError:
+                    pass
+    # the staging directory is inside js_outdir, so don't leave it around
+    shutil.rmtree(os.path.join(grcfg['js_outdir'], STAGING_DIR), ignore_errors=True)
+    if len(staged_names) > 0:
+        # make the renames themselves durable
+        dir_fd = os.open(grcfg['js_outdir'], os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    now = int(time.time())
+    retired = load_state('retired.json')
+    for name in retired_output:
+        retired.setdefault(name, now)
+    for name in staged_names:
+        # back in use (file names are content hashes, content can come back)
+        retired.pop(name, None)
+    for name, retired_at in list(retired.items()):
+        if now - retired_at >= grcfg.getint('retire_grace'):
+            remove_output(name)
+            del retired[name]
+    save_state('retired.json', retired)
+    metrics.gauges['retired_files'] = len(retired)
+    del staged_output[:]
+    del retired_output[:]
+    return staged_names
+
+
+def hashed_name(name, raw):
+    '''<name>.<part of the content hash of raw> if hashed_filenames is set, just name otherwise'''
+    if not grcfg.getboolean('hashed_filenames'):
+        return name
+    return '.'.join([name, hashlib.sha256(raw).hexdigest()[:12]])
+
+
+def write_menu_pack(setlist, known_collections, table=None, facets=None):
+    '''write js_outdir/menupack.json, which holds the setlist and all collections in one file
+
+browsers with an empty or mostly outdated localStorage can get everything with a single request.
+known_collections maps ids to collection data we already have in memory, others are read from disk.
+if the collections refer to a ResourceTable, pass it as table, same with a FacetTable as facets'''
+    pack_collections = collections.OrderedDict()
+    for setlist_item in setlist:
+        if setlist_item['id'] in known_collections:
+            pack_collections[setlist_item['id']] = known_collections[setlist_item['id']]
+        else:
+            with open(output_path(setlist_item.get('file', setlist_item['id'])), 'r') as collection_file:
+                pack_collections[setlist_item['id']] = json.load(collection_file,
+                                                                 object_pairs_hook=collections.OrderedDict)
+    pack = collections.OrderedDict([('setlist', setlist), ('collections', pack_collections)])
+    if table is not None:
+        pack['resources'] = collections.OrderedDict([('file', table.name), ('entries', table.entries)])
+    if facets is not None:
+        pack['facets'] = collections.OrderedDict([('file', facets.name), ('values', facets.values)])
+    return write_output('menupack', pack)
+
+
+def load_state(name):
+    '''load a JSON file from state_dir, returns an empty dict if there is none (yet)'''
+    try:
+        with open(os.path.join(grcfg['state_dir'], name), 'r') as statefile:
+            return json.load(statefile, object_pairs_hook=collections.OrderedDict)
+    except (OSError, ValueError):
+        return collections.OrderedDict()
+
+
+def save_state(name, data):
+    '''write data as JSON into a file in state_dir, replacing the old file only once writing succeeded'''
+    os.makedirs(grcfg['state_dir'], exist_ok=True)
+    statepath = os.path.join(grcfg['state_dir'], name)
+    with open(''.join([statepath, '.tmp']), 'w') as statefile:
+        json.dump(data, statefile)
+    os.replace(''.join([statepath, '.tmp']), statepath)
+
+
+def begin_run():
+    '''start collecting RunMetrics for a new run, and profiling data if configured'''
+    global metrics
+    metrics = RunMetrics()
+    metrics.start([name.strip() for name in grcfg['profile'].split(';')])
+
+
+def end_run(success):
+    '''stop collecting metrics for the current run, write them and any profiling data where configured
+
+the output of a run that failed is discarded, see discard_output()'''
+    snapshot = metrics.stop(success)
+    if not success:
+        # don't leave staged files in js_outdir until the next run
+        discard_output()
+    os.makedirs(grcfg['state_dir'], exist_ok=True)
+    if metrics.profiler is not None:
+        metrics.profiler.dump_stats(os.path.join(grcfg['state_dir'], 'profile.pstats'))
+    if snapshot is not None:
+        with open(os.path.join(grcfg['state_dir'], 'tracemalloc.txt'), 'w') as tracefile:
+            tracefile.write(''.join(['peak: ', str(metrics.gauges['peak_traced_memory_bytes']), ' bytes\n']))
+            for stat in snapshot.statistics('lineno')[:25]:
+                tracefile.write(''.join([str(stat), '\n']))
+    if grcfg.getboolean('run_report'):
+        save_state('run_report.json', metrics.report())
+    if grcfg['metrics_file'] != '':
+        # the textfile collector might read it at any time, so it needs to be replaced atomically
+        with open(''.join([grcfg['metrics_file'], '.tmp']), 'w') as promfile:
+            promfile.write(metrics.prometheus())
+        os.replace(''.join([grcfg['metrics_file'], '.tmp']), grcfg['metrics_file'])
+    print(''.join(['Run ', 'finished' if success else 'failed', ' after ', '{0:.1f}'.format(metrics.duration),
+                   ' seconds (', ', '.join(''.join([name, ' ', '{0:.1f}'.format(value), 's'])
+                                           for name, value in metrics.phases.items()), ')']))
+    if len(metrics.critical_path) > 0:
+        print(''.join(['Critical path: ', ' > '.join(''.join([name, ' ', '{0:.1f}'.format(value), 's'])
+                                                      for name, value in metrics.critical_path),
+                       ' (', '{0:.1f}'.format(metrics.gauges['critical_path_seconds']), 's of ',
+                       '{0:.1f}'.format(sum(metrics.phases.values())), 's spent in phases)']))
+
+
+def load_host_index(path=None):
+    '''set up host_index from the stanzas in path (eres_path by default) and the highlight1 hosts
+
+the index is only built again if the file or the config changed since last time.
+without a file, the index only knows the proxy and highlight hosts. returns host_index'''
+    global host_index
+    if path is None:
+        path = grcfg['eres_path']
+    try:
+        file_stat = os.stat(path)
+        source = (path, file_stat.st_mtime, file_stat.st_size, grcfg['proxy_hostname'], grcfg['highlight1'])
+    except OSError:
+        file_stat = None
+        source = (path, None, None, grcfg['proxy_hostname'], grcfg['highlight1'])
+    if host_index is not None and host_index.source == source:
+        return host_index
+    new_index = HostIndex(grcfg['proxy_hostname'], grcfg['highlight1'])
+    new_index.source = source
+    if file_stat is not None:
+        with ERessourcesFile(path, 'r') as eresfile:
+            for stanza in eresfile:
+                new_index.add_stanza(stanza)
+        print(''.join(['Indexed ', str(len(new_index.hosts)), ' hosts and ', str(len(new_index.domains)),
+                       ' domains EZProxy proxies (from ', path, ')']))
+    host_index = new_index
+    return host_index
+
+
+def write_eresources(src_path, dest_path, inj_url):
+    '''add injection code to each stanza of src_path and put the result at dest_path
+
+dest_path is only replaced if the result differs from what is already there.
+a fingerprint of each stanza is kept in state_dir, so we can tell which stanzas
+were added, removed or changed since the last time. returns True if dest_path was replaced'''
+    old_index = load_state('eresources_index.json')
+    old_stanzas = old_index.get('stanzas', {})
+    new_stanzas = collections.OrderedDict()
+    filesha = hashlib.sha256()
+    tmp_path = ''.join([dest_path, '.new'])
+    with ERessourcesFile(src_path, 'r') as repofile, open(tmp_path, 'w') as outfile:
+        for stanza in repofile:
+            stanza.add_injection(inj_url)
+            stanza_text = str(stanza)
+            outfile.write(stanza_text)
+            stanza_bytes = stanza_text.encode('utf-8')
+            filesha.update(stanza_bytes)
+            # Title/URL pairs are not guaranteed to be unique, number the duplicates
+            key = '\t'.join([stanza.title, stanza.url])
+            dupe_count = 1
+            while key in new_stanzas:
+                dupe_count += 1
+                key = ''.join(['\t'.join([stanza.title, stanza.url]), ' #', str(dupe_count)])
+            # leave inj_url out, so a new version of the script does not make every stanza look changed
+            new_stanzas[key] = hashlib.sha256(stanza_text.replace(inj_url, '').encode('utf-8')).hexdigest()
+    new_index = {'file_digest': filesha.hexdigest(), 'injection_url': inj_url, 'stanzas': new_stanzas}
+    if filesha.hexdigest() == file_hexdigest(dest_path):
+        os.remove(tmp_path)
+        save_state('eresources_index.json', new_index)
+        print('\tNo effective changes to eResources.txt, keeping the installed file')
+        return False
+    url_changed = old_index.get('injection_url', inj_url) != inj_url
+    if url_changed:
+        print(''.join(['\tInjection URL changed from ', old_index['injection_url'], ' to ', inj_url]))
+    if len(old_stanzas) == 0:
+        print('\tNo stanza index from an earlier run, cannot tell which stanzas changed')
+    else:
+        added = [key for key in new_stanzas if key not in old_stanzas]
+        removed = [key for key in old_stanzas if key not in new_stanzas]
+        changed = [key for key in new_stanzas if key in old_stanzas and new_stanzas[key] != old_stanzas[key]]
+        for label, keys in (('added', added), ('removed', removed), ('changed', changed)):
+            print(''.join(['\tStanzas ', label, ': ', str(len(keys))]))
+            for key in keys:
+                print(''.join(['\t\t', key.replace('\t', ' - ')]))
+        if len(added) + len(removed) + len(changed) == 0 and not url_changed:
+            print('\tSame stanzas as before, but in a different order')
+    os.replace(tmp_path, dest_path)
+    save_state('eresources_index.json', new_index)
+    return True
+
+
+def versioned_injection_url(installed_url=None):
+    '''injection_url with a hash of injection_file added as query, injection_url itself if that is not set
+
+a new build of the script gets a new URL this way, so browsers can cache each one for good.
+if injection_file can't be read, installed_url (the URL the current eResources.txt uses)
+is kept, so a missing build does not cause a rewrite'''
+    url = grcfg['injection_url']
+    if grcfg['injection_file'] is None or grcfg['injection_file'] == '':
+        return url
+    digest = file_hexdigest(os.path.expanduser(grcfg['injection_file']))
+    if digest is None:
+        print(''.join(['WARNING: Could not read injection_file ', grcfg['injection_file'],
+                       ', keeping the injection URL as it is']))
+        return installed_url or url
+    return ''.join([url, '&' if '?' in url else '?', 'v=', digest[:12]])
+
+
+def ezproxy_pid():
+    '''the pid in ezproxy_pidfile if there is a process with that pid, None otherwise'''
+    try:
+        with open(grcfg['ezproxy_pidfile'], 'r') as pidfile:
+            pid = int(pidfile.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        # it's there, it's just not ours
+        return pid
+    except OSError:
+        return None
+    return pid
+
+
+def ezproxy_not_ready(old_pid=None):
+    '''checks whether EZProxy is up: a new pid in ezproxy_pidfile (if configured), a listening port
+and an answer from its login page. returns what it is still waiting for, None if EZProxy is ready
+
+without ezproxy_pidfile, an old EZProxy that is still shutting down passes the port and login page
+checks as well, so this can report ready a little early'''
+    if grcfg['ezproxy_pidfile'] != '':
+        pid = ezproxy_pid()
+        if pid is None or pid == old_pid:
+            return 'pidfile'
+    if grcfg['proxy_login_port'] != '':
+        port = int(grcfg['proxy_login_port'][1:])
+    else:
+        port = 443 if PROTO == PROTO_HTTPS else 80
+    try:
+        socket.create_connection((grcfg['proxy_hostname'], port), timeout=1).close()
+    except OSError:
+        return 'port'
+    try:
+        r0 = requests.get(''.join([PROTO, grcfg['proxy_hostname'], grcfg['proxy_login_port'], '/login']),
+                          allow_redirects=False, timeout=2)
+    except requests.exceptions.RequestException:
+        return 'login page'
+    if r0.status_code >= 500:
+        return 'login page'
+    return None
+
+
+def restart_ezproxy():
+    '''run "ezproxy restart" and wait until EZProxy is ready again, see ezproxy_not_ready()
+
+polls with increasing delays until restart_timeout is over, in which case RestartError is raised.
+returns how many seconds EZProxy took to become ready, each restart is also recorded in state_dir'''
+    old_pid = ezproxy_pid() if grcfg['ezproxy_pidfile'] != '' else None
+    started = time.monotonic()
+    print('Restarting EZProxy with new configuration')
+    print(''.join(['--- output from running "', grcfg['ezproxy_executable'], ' restart" ---']))
+    restart_command = [grcfg['ezproxy_executable'], 'restart']
+    restart_output = subprocess.check_output(' '.join(restart_command), shell=True, universal_newlines=True)
+    print(restart_output)
+    print('--- end subprocess output ---')
+    print('waiting for EZProxy to start up...')
+    deadline = started + grcfg.getfloat('restart_timeout')
+    delay = 0.1
+    waiting_for = ezproxy_not_ready(old_pid)
+    while waiting_for is not None and time.monotonic() < deadline:
+        time.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+        delay = min(delay * 2, 2.0)
+        waiting_for = ezproxy_not_ready(old_pid)
+    duration = time.monotonic() - started
+    restarts = load_state('restarts.json').get('restarts', [])
+    restarts.append({'time': int(time.time()), 'seconds': round(duration, 2), 'waiting_for': waiting_for})
+    save_state('restarts.json', {'restarts': restarts[-20:]})
+    if waiting_for is not None:
+        metrics.gauges['restart_ready_seconds'] = duration
+        raise RestartError(''.join(['EZProxy not ready after ', '{0:.1f}'.format(duration),
+                                    ' seconds, still waiting for its ', waiting_for]))
+    print(''.join(['\t...EZProxy ready after ', '{0:.1f}'.format(duration), ' seconds']))
+    metrics.gauges['restart_ready_seconds'] = duration
+    return duration
+
+
+def collection_delta(old_list, new_list):
+    '''describe the changes from one version of a collection's data (or refs) to the next
+
+entries are identified by delta_key(). returns a dict with keys of 'removed' entries,
+'modified' entries and [index, entry] pairs of 'added' entries, or None if the
+change can't be expressed that way (duplicate keys, entries that moved)'''
+    old_entries = collections.OrderedDict((delta_key(entry), entry) for entry in old_list)
+    new_keys = set(delta_key(entry) for entry in new_list)
+    if len(old_entries) != len(old_list) or len(new_keys) != len(new_list):
+        return None
+    delta = collections.OrderedDict()
+    delta['removed'] = [key for key in old_entries if key not in new_keys]
+    delta['modified'] = [entry for entry in new_list
+                         if delta_key(entry) in old_entries and entry != old_entries[delta_key(entry)]]
+    delta['added'] = [[index, entry] for index, entry in enumerate(new_list) if delta_key(entry) not in old_entries]
+    if apply_collection_delta(old_list, delta) != new_list:
+        return None
+    return delta
+
+
+def apply_collection_delta(old_list, delta):
+    '''counterpart of collection_delta(), frontend/src/common/applyCollectionPatch.ts does the same'''
+    removed = set(delta['removed'])
+    modified = dict((delta_key(entry), entry) for entry in delta['modified'])
+    new_list = [modified.get(delta_key(entry), entry) for entry in old_list if delta_key(entry) not in removed]
+    for index, entry in delta['added']:
+        new_list.insert(index, entry)
+    return new_list
+
+
+def title_initial(title):
+    '''what a collection entry is filed under in paged collections: its first letter, '#' if that is none'''
+    initial = title.strip()[:1].upper()
+    return initial if initial.isalpha() else '#'
+
+
+def distinct_prefix(title, neighbour):
+    '''the shortest start of title that differs from the start of neighbour, for page labels like "Ca - Co"'''
+    length = 1
+    while length < len(title) and title[:length].casefold() == neighbour[:length].casefold():
+        length += 1
+    return title[:length].strip()
+
+
+def page_ranges(titles, page_size):
+    '''split a list of sorted titles into pages of at most page_size titles
+
+pages hold whole initials (see title_initial()) where possible, so a new entry
+only changes the page it goes into. returns (start, end) index pairs'''
+    ranges = []
+    start = 0
+    index = 0
+    while index < len(titles):
+        group_end = index
+        while group_end < len(titles) and title_initial(titles[group_end]) == title_initial(titles[index]):
+            group_end += 1
+        if group_end - start > page_size and index > start:
+            ranges.append((start, index))
+            start = index
+        # initials with more entries than fit on a page are cut into pages of their own
+        while group_end - start > page_size:
+            ranges.append((start, start + page_size))
+            start += page_size
+        index = group_end
+    if start < len(titles):
+        ranges.append((start, len(titles)))
+    return ranges
+
+
+def paged_by(entry_count, page_size):
+    '''the page size a collection of entry_count entries is split by, 0 if it fits on one page'''
+    return page_size if 0 < page_size < entry_count else 0
+
+
+def paginate(collection, entries, page_size):
+    '''split collection into its first page and the files for the other pages, sorted by title
+
+entries are the data the collection's 'data' or 'refs' stand for. the collection that is
+returned keeps the entries of the first page, and lists all pages with a label and their
+size in 'pages'. the others are returned as a list of (file name, page data), with the
+file names hashed like the resource table's, so browsers can keep each page by its name'''
+    list_key = 'refs' if 'refs' in collection else 'data'
+    order = sorted(range(len(entries)), key=lambda index: entries[index]['title'].casefold())
+    titles = [entries[index]['title'] for index in order]
+    items = [collection[list_key][index] for index in order]
+    ranges = page_ranges(titles, page_size)
+    first_page = collections.OrderedDict((key, value) for key, value in collection.items() if key != list_key)
+    descriptors = []
+    page_files = []
+    for page, (start, end) in enumerate(ranges):
+        label = ''.join([distinct_prefix(titles[start], titles[start - 1]) if start > 0 else titles[start][:1],
+                         ' - ',
+                         distinct_prefix(titles[end - 1], titles[end]) if end < len(titles) else titles[end - 1][:1]])
+        descriptor = collections.OrderedDict([('label', label), ('count', end - start)])
+        if page == 0:
+            first_page[list_key] = items[start:end]
+        else:
+            page_raw = MINIFIED_JSON.encode(items[start:end]).encode('utf-8')
+            page_name = ''.join([collection['id'], '.p', str(page), '.', hashlib.sha256(page_raw).hexdigest()[:12]])
+            descriptor['file'] = page_name
+            page_files.append((page_name, collections.OrderedDict([
+                ('id', collection['id']), ('page', page), ('file', page_name), (list_key, items[start:end])])))
+        descriptors.append(descriptor)
+    first_page['pages'] = descriptors
+    return first_page, page_files
+
+
+def read_output(name):
+    '''load js_outdir/<name>.json, the version this run is about to publish if it wrote one'''
+    with open(output_path(name, staged=name in staged_output), 'r') as infile:
+        return json.load(infile, object_pairs_hook=collections.OrderedDict)
+
+
+def collection_refs(collection):
+    '''all refs of a collection, including those on the other pages of a paged one'''
+    # files of failed collections may still have data, if resource_table was just switched on
+    refs = list(collection.get('refs', []))
+    for page in collection.get('pages', []):
+        if 'file' in page:
+            refs.extend(read_output(page['file']).get('refs', []))
+    return refs
+
+
+def facet_fields():
+    '''the ReNa fields configured in facet_fields'''
+    return [field.strip() for field in grcfg['facet_fields'].split(';') if field.strip() != '']
+
+
+def written_entries(collection, resource_table):
+    '''the entries of one of our collection files in the order browsers get them, other pages included'''
+    entries = list(collection_entries(collection, resource_table))
+    for page in collection.get('pages', []):
+        if 'file' in page:
+            entries.extend(collection_entries(read_output(page['file']), resource_table))
+    return entries
+
+
+def search_terms(title):
+    '''the terms of title for the search index: without diacritics, in lower case, letters and digits only
+
+frontend/src/search.ts does the same to queries'''
+    decomposed = unicodedata.normalize('NFKD', title)
+    folded = ''.join(char for char in decomposed if not unicodedata.category(char).startswith('M')).lower()
+    return SEARCH_TERM_RE.findall(folded)
+
+
+def search_postings(entries):
+    '''the part of the search index for one collection: positions of its entries by term'''
+    postings = {}
+    for position, entry in enumerate(entries):
+        for term in set(search_terms(entry['title'])):
+            postings.setdefault(term, []).append(position)
+    return postings
+
+
+def merge_search_postings(set_ids, set_postings):
+    '''the search index for the collections in set_ids, from search_postings() of each
+
+terms are sorted, so browsers find all terms with a prefix by binary search. the postings of
+each term are a flat list of collection (index into set_ids) and position pairs, trigrams list
+the terms they appear in, for searches within terms'''
+    merged = {}
+    for collection_index, set_id in enumerate(set_ids):
+        for term, positions in set_postings[set_id].items():
+            flat = merged.setdefault(term, [])
+            for position in positions:
+                flat.extend((collection_index, position))
+    terms = sorted(merged)
+    trigrams = {}
+    for term_index, term in enumerate(terms):
+        for trigram in set(term[start:start + 3] for start in range(len(term) - 2)):
+            trigrams.setdefault(trigram, []).append(term_index)
+    return collections.OrderedDict([('collections', list(set_ids)),
+                                    ('terms', terms),
+                                    ('postings', [merged[term] for term in terms]),
+                                    ('trigrams', collections.OrderedDict(sorted(trigrams.items())))])
+
+
+def good_rena_entries_to_array(entries, log=print, record_ids=None, stats=None, hosts=None):
+    '''copy good items from ReNa JSON response obj into array, discard dict keys
+
+entries can be the decoded response or an iterable of (record id, entry) pairs like RenaRecordStream.
+log is called with each line of output, defaults to print.
+if record_ids is a list, the keys of the items copied are appended to it.
+if stats is a dict, the entry counts are put into it (see RunMetrics).
+urls are classified with hosts, a HostIndex, or the one load_host_index() built if not given'''
     # TODO(krugar): more data integrity checks -> OWASP json sanitizer?
+    if hosts is None:
+        hosts = host_index if host_index is not None else HostIndex(grcfg['proxy_hostname'], grcfg['highlight1'])
+    fields = facet_fields()
     total_urls = 0
     proxied_urls = 0
+    covered_urls = 0
+    alerts = 0
     ret_arr = []  # array to preserve ordering on js side
-    for rena_entry in list(entries.values()):
+    for record_id, rena_entry in (entries.items() if hasattr(entries, 'items') else entries):
         if 'title' not in rena_entry or 'access_txtF' not in rena_entry:
             continue
         if ('naturl_str_mv' not in rena_entry or rena_entry['naturl_str_mv'][0] is None):
@@ -264,16 +1476,37 @@ def good_rena_entries_to_array(entries):
         list_item['title'] = tmp if isinstance(tmp, str) else tmp[0]
         tmp = rena_entry['naturl_str_mv'][0]
         list_item['url'] = tmp if isinstance(tmp, str) else tmp[0]
-        list_item['proxied'] = grcfg['proxy_hostname'] in list_item['url']
-        list_item['free'] = rena_entry['access_txtF'] == 'FREE'
+        proxied, covered, highlight = hosts.classify(list_item['url'])
+        if covered and grcfg.getboolean('rewrite_covered'):
+            # ReNa has it unproxied, but EZProxy would proxy it. send users through the login,
+            # qurl takes the URL encoded, so its own query and fragment stay intact
+            list_item['url'] = ''.join([PROTO, grcfg['proxy_hostname'], grcfg['proxy_login_port'], '/login?qurl=',
+                                        quote(list_item['url'], safe='')])
+            proxied = True
+            covered_urls += 1
+        # boolean flags are left out when false to keep the output small
+        free = rena_entry['access_txtF'] == 'FREE'
+        if proxied:
+            list_item['proxied'] = True
+        if free:
+            list_item['free'] = True
         if 'description' in rena_entry:
             list_item['desc'] = rena_entry['description']
-        for h1_host in grcfg['highlight1'].split(';'):
-            if h1_host in list_item['url']:
-                list_item['highlight1'] = True
-
+        if highlight:
+            list_item['highlight1'] = True
+        # repeated strings, sync_collections() has a FacetTable turn them into indexes
+        facets = collections.OrderedDict()
+        for field in fields:
+            tmp = rena_entry.get(field)
+            if isinstance(tmp, str):
+                tmp = [tmp]
+            if isinstance(tmp, list) and len(tmp) > 0:
+                facets[field] = [str(value) for value in tmp]
+        if len(facets) > 0:
+            list_item['facets'] = facets
 
-        # NOTE: this is the place where you can ferry more ReNa data over to the javascript side
+        # NOTE: this is the place where you can ferry more ReNa data over to the javascript side.
+        # fields with lists of values that repeat a lot are best added to facet_fields in grabrena.ini
         # common fields you could use:
         # 'title': 'some string, name we use in the menu'
         # 'naturl_str_mv': ['URL leading this resource', ...]  # NOTE: array field with usually just one entry
@@ -286,15 +1519,149 @@ def good_rena_entries_to_array(entries):
         # 'rank_str_mv' -> ['array', 'of', 'institute', 'handles']  # MBRG in our case ;)
 
         total_urls += 1
-        if list_item['proxied']:
+        if proxied:
             proxied_urls += 1
-        if not list_item['proxied'] and not list_item['free']:
-            print(''.join(['\tALERT: "', str(list_item['title']), '" is not proxied and not free']))
+        if not proxied and not free:
+            alerts += 1
+            log(''.join(['\tALERT: "', str(list_item['title']), '" is not proxied and not free']))
         ret_arr.append(list_item)
-    print(''.join(['\tURLs in this Collection: ', str(total_urls), ', thereof proxied: ', str(proxied_urls)]))
+        if record_ids is not None:
+            record_ids.append(record_id)
+    log(''.join(['\tURLs in this Collection: ', str(total_urls), ', thereof proxied: ', str(proxied_urls)]))
+    if covered_urls > 0:
+        log(''.join(['\t', str(covered_urls), ' of them unproxied in ReNa, but covered by a stanza']))
+    if stats is not None:
+        stats['entries'] = total_urls
+        stats['proxied'] = proxied_urls
+        stats['covered'] = covered_urls
+        stats['unproxied'] = total_urls - proxied_urls
+        stats['not_proxied_not_free'] = alerts
     return ret_arr
 
 
+def session_expired(response):
+    '''EZProxy redirects requests with an expired session cookie to its login page'''
+    return urlparse(response.url).path.startswith('/login')
+
+
+def retryable(error):
+    '''whether error is likely to go away if we try again: network trouble, timeouts,
+5xx and 429 answers, and responses that broke off in the middle of the JSON'''
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and (error.response.status_code >= 500
+                                               or error.response.status_code == 429)
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              requests.exceptions.ChunkedEncodingError, ValueError))
+
+
+def with_retries(attempt, deadline=None, log=print):
+    '''call attempt() until it succeeds, at most retries + 1 times
+
+waits a random time of up to retry_backoff, 2 * retry_backoff, 4 * retry_backoff, ... seconds
+between tries, so a hiccup on ReNa's side doesn't get all our workers back at the same moment.
+errors that are not retryable() are raised right away, the last one is raised if we run
+out of tries or the next one would start after deadline (a time.monotonic() value)'''
+    tries = 0
+    while True:
+        tries += 1
+        try:
+            return attempt()
+        except Exception as e:
+            if not retryable(e) or tries > grcfg.getint('retries'):
+                raise
+            delay = random.uniform(0, grcfg.getfloat('retry_backoff') * 2 ** (tries - 1))
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise
+            log(''.join(['\tTry ', str(tries), ' failed (', type(e).__name__, ': ', str(e),
+                         '), trying again in ', '{0:.1f}'.format(delay), ' seconds']))
+            time.sleep(delay)
+
+
+def until_deadline(chunks, deadline):
+    '''pass chunks through, raise requests' Timeout once deadline (a time.monotonic() value) has passed
+
+the read timeout only applies to each chunk, a response that trickles in could take forever'''
+    for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise requests.exceptions.Timeout('collection_timeout exceeded while reading the response')
+        yield chunk
+
+
+def fetch_rena_collection(session, renaset, validators=None, stats=None):
+    '''query ReNa for a single collection. runs in a worker thread
+
+if validators (a dict with 'etag' and/or 'last_modified') are given, the request is
+made conditional. returns the filtered entries (None if ReNa answered 304 Not Modified),
+their ReNa record ids, the validators of the response and the output
+good_rena_entries_to_array produced, so the caller can print it in setlist order.
+failed requests are retried (see with_retries), all tries together may take collection_timeout
+seconds. timings, sizes and counts go into stats, if given (see RunMetrics)'''
+    messages = []
+    if stats is None:
+        stats = {}
+    headers = {}
+    if validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    deadline = time.monotonic() + grcfg.getfloat('collection_timeout')
+    stats['tries'] = 0
+
+    def attempt():
+        stats['tries'] += 1
+        record_ids = []
+        entry_messages = []
+        # the response is parsed while it arrives, instead of keeping all of it in memory
+        with session.get(renaset['url'], params={'view': 'JSON'}, headers=headers, stream=True,
+                         timeout=grcfg.getfloat('request_timeout')) as r2:
+            if r2.status_code == 304 and headers:
+                return None, None, validators, messages
+            r2.raise_for_status()
+            if session_expired(r2):
+                raise LoginError('EZProxy sent us to its login page, our session has expired')
+            new_validators = {'etag': r2.headers.get('ETag'), 'last_modified': r2.headers.get('Last-Modified')}
+            records = RenaRecordStream(until_deadline(r2.iter_content(RENA_CHUNK_SIZE), deadline), r2.encoding)
+            data_list = good_rena_entries_to_array(records, log=entry_messages.append, record_ids=record_ids,
+                                                   stats=stats)
+            stats['bytes'] = records.size
+            stats['network_seconds'] = records.waited
+        return data_list, record_ids, new_validators, messages + entry_messages
+
+    with RunMetrics.timed(stats, 'fetch_seconds'):
+        return with_retries(attempt, deadline, log=messages.append)
+
+
+def fetch_shared(session, renaset, validators=None, stats=None):
+    '''fetch_rena_collection(), unless an earlier target already got the collection from the same URL
+
+only while running targets (see run_target_group()), the entries depend on the host index,
+rewrite_covered and facet_fields as well, so these have to be the same too. if validators match those
+of the earlier response, the result is the same as if ReNa had answered 304 Not Modified'''
+    if shared_fetches is None:
+        return fetch_rena_collection(session, renaset, validators, stats)
+    if stats is None:
+        stats = {}
+    key = (renaset['url'], host_index.source if host_index is not None else None, grcfg['rewrite_covered'],
+           grcfg['facet_fields'])
+    shared = shared_fetches.get(key)
+    if shared is None:
+        result = fetch_rena_collection(session, renaset, validators, stats)
+        if result[0] is not None:
+            shared_fetches[key] = (result, dict(stats))
+        return result
+    (data_list, record_ids, new_validators, messages), shared_stats = shared
+    # the counts of the entries, but not the time and bytes it took to get them
+    stats.update((name, value) for name, value in shared_stats.items()
+                 if not name.endswith('_seconds') and name not in ('bytes', 'tries'))
+    stats['tries'] = 0
+    stats['shared'] = True
+    if validators is not None and any(validators.get(name) and validators[name] == new_validators[name]
+                                      for name in ('etag', 'last_modified')):
+        return None, None, validators, messages
+    return data_list, record_ids, new_validators, messages + ['\tGot this one for an earlier target already']
+
+
 # ~~~ CONFIG HANDLING ~~~
 OUT_FNNAME = 'fromRemote'
 OUT2_FNNAME = 'getSets'
@@ -302,12 +1669,17 @@ PROTO_HTTP = 'http://'
 PROTO_HTTPS = 'https://'
 
 configfile = 'grabrena.ini'
+# sections for additional menus, [target <name>], see run_targets()
+TARGET_PREFIX = 'target '
+# the name the menu of [grabrena] itself goes by among the targets
+MAIN_TARGET = 'grabrena'
 defaultconfig = {
     'institute': 'MBRG',
     'proxy_hostname': 'go.coll.mpg.de',
     'proxy_login_port': '',
     'js_outdir': '../src/js/loggedin/',
     'injection_url': 'https://go.coll.mpg.de/loggedin/injectmenu.js',
+    'injection_file': '',
     'username': 'grabrena',
     'password': '12345',
     'use_https': 'Yes',
@@ -316,65 +1688,177 @@ defaultconfig = {
     'svn_opt_cfgdir': '',
     'force_eRes_update': 'No',
     'ezproxy_executable': '/usr/local/ezproxy/ezproxy',
-    'cookie_name': 'ezproxy'
-}
-config = configparser.ConfigParser()
-config['DEFAULT'] = defaultconfig
-config['grabrena'] = {}
-try:
-    with open(configfile, 'r') as confh:
-        config.readfp(confh)
-except OSError:
-    print(''.join(['No config file found (at ',
-                   configfile,
-                   '), creating one with default values']))
-    with open(configfile, 'w') as confh:
-        config.write(confh)
-        confh.write(
-            '\n'.join([
-                '## you can copy from the DEFAULT section above & set your own values',
-                '# proxy_hostname: hostname of your EZProxy installation',
-                '# proxy_login_port: in case you run a virtual port setup, where to connect to from localhost',
-                '# use_https: whether to connect to your EZProxy via HTTPS ("yes"/"no" works)',
-                '# username: credentials this script uses to log into your ezproxy installation',
-                '# password: as above',
-                '#',
-                '# institute: your MPIs shorthand as used on https://rena.mpdl.mpg.de/rena/Ext/PredefinedSets',
-                '# js_outdir: where to put json files with menu data',
-                '#',
-                '# svn_up_path: (optional) path to the eResources.txt file in your local TravelMagic svn repo.',
-                '#              If set, we will call "svn up" on it to check for updates from TravelMagic.',
-                '#              You can use this and force_eRes_update below to transform your eRes file',
-                '#              even if it is not in an svn repository (svn errors will not terminate the script)',
-                '# svn_opt_cfgdir: (optional) path to a svn config dir (passed into svn via --config-dir)',
-                '# eres_path: (required if svn_up_path is set) where to put a new eResources.txt if there were updates',
-                '# force_eRes_update: you can set this to Yes to force copying of eResources.txt',
-                '# ezproxy_executable: (optional) your ezproxy executable with path, used to call "ezproxy restart"',
-                '# cookie_name: name of the cookie your ezproxy sets for authentication',
-                '']))
-    raise GrabrenaError('No config found, please edit the file we created for you')
-grcfg = config['grabrena']
-if grcfg['proxy_login_port'] is not '' and ':' not in grcfg['proxy_login_port']:
-    grcfg['proxy_login_port'] = ''.join([':', str(grcfg['proxy_login_port'])])
-if grcfg.getboolean('use_https'):
-    RENA_URL = 'https://rena-mpdl-mpg-de.{0}{1}/rena/'.format(grcfg['proxy_hostname'], grcfg['proxy_login_port'])
-    PROTO = PROTO_HTTPS
-else:
-    RENA_URL = 'http://rena.mpdl.mpg.de.{0}{1}/rena/'.format(grcfg['proxy_hostname'], grcfg['proxy_login_port'])
-    PROTO = PROTO_HTTP
-FULLCATALOG_ITEM = {
-    'id': 'Everything',
-    'name': 'Everything',
-    'url': ''.join([RENA_URL, 'Search/Results?lookfor=&type=AllFields']),
-    'logo': 'two'
+    'cookie_name': 'ezproxy',
+    'fetch_workers': '4',
+    'state_dir': 'state/',
+    'delta_history': '5',
+    'precompress': 'gz;br',
+    'hashed_filenames': 'Yes',
+    'menu_pack': 'Yes',
+    'resource_table': 'Yes',
+    'daemon_interval': '21600',
+    'ezproxy_pidfile': '',
+    'restart_timeout': '60',
+    'metrics_file': '',
+    'run_report': 'Yes',
+    'profile': '',
+    'retries': '3',
+    'retry_backoff': '2',
+    'request_timeout': '60',
+    'collection_timeout': '600',
+    'error_budget': '0.25',
+    'retire_grace': '86400',
+    'highlight1': '',
+    'rewrite_covered': 'No',
+    'page_size': '1000',
+    'facet_fields': '',
+    'search_index': 'Yes',
+    'target_workers': '4'
 }
+# set up by load_config()
+grcfg = None
+RENA_URL = None
+PROTO = None
+FULLCATALOG_ITEM = None
+# timings and counts of the current run, see begin_run()
+metrics = RunMetrics()
+# hosts EZProxy proxies, see load_host_index()
+host_index = None
+# names of the files written and retired since the last commit_output()
+staged_output = []
+retired_output = []
+# fetch results other targets can use as well, only while running targets, see fetch_shared()
+shared_fetches = None
+
+
+def load_config(path=configfile, target=None):
+    '''read the ini file at path, or write one with default values and raise GrabrenaError
+
+with target, the values in its [target <name>] section replace those in [grabrena]
+(MAIN_TARGET stands for [grabrena] itself). sets up grcfg and the URLs derived from it, returns grcfg'''
+    global grcfg, RENA_URL, PROTO, FULLCATALOG_ITEM
+    config = configparser.ConfigParser()
+    config['DEFAULT'] = defaultconfig
+    config['grabrena'] = {}
+    try:
+        with open(path, 'r') as confh:
+            config.read_file(confh)
+        if target is not None and target != MAIN_TARGET:
+            # read again with [grabrena] as the defaults of the target sections, so a target
+            # section gives us all of [grabrena] with its own values on top
+            targets = configparser.ConfigParser(default_section='grabrena', interpolation=None)
+            with open(path, 'r') as confh:
+                targets.read_file(confh)
+            if not targets.has_section(''.join([TARGET_PREFIX, target])):
+                raise GrabrenaError(''.join(['No section [', TARGET_PREFIX, target, '] in ', path]))
+            config.read_dict({'grabrena': dict(targets[''.join([TARGET_PREFIX, target])])})
+    except OSError:
+        print(''.join(['No config file found (at ',
+                       path,
+                       '), creating one with default values']))
+        with open(path, 'w') as confh:
+            config.write(confh)
+            confh.write(
+                '\n'.join([
+                    '## you can copy from the DEFAULT section above & set your own values',
+                    '# proxy_hostname: hostname of your EZProxy installation',
+                    '# proxy_login_port: in case you run a virtual port setup, where to connect to from localhost',
+                    '# use_https: whether to connect to your EZProxy via HTTPS ("yes"/"no" works)',
+                    '# username: credentials this script uses to log into your ezproxy installation',
+                    '# password: as above',
+                    '#',
+                    '# institute: your MPIs shorthand as used on https://rena.mpdl.mpg.de/rena/Ext/PredefinedSets',
+                    '# js_outdir: where to put json files with menu data',
+                    '#',
+                    '# svn_up_path: (optional) path to the eResources.txt file in your local TravelMagic svn repo.',
+                    '#              If set, we will call "svn up" on it to check for updates from TravelMagic.',
+                    '#              You can use this and force_eRes_update below to transform your eRes file',
+                    '#              even if it is not in an svn repository (svn errors will not terminate the script)',
+                    '# svn_opt_cfgdir: (optional) path to a svn config dir (passed into svn via --config-dir)',
+                    '# eres_path: (required if svn_up_path is set) where to put a new eResources.txt if there were updates',
+                    '# force_eRes_update: you can set this to Yes to force copying of eResources.txt',
+                    '# injection_file: (optional) the injectmenu.js injection_url points to, on this machine. if set,',
+                    '#                 a hash of it is added to injection_url, and eResources.txt is rewritten',
+                    '#                 whenever the hash changes, so the script can be served with long-lived caching',
+                    '# ezproxy_executable: (optional) your ezproxy executable with path, used to call "ezproxy restart"',
+                    '# ezproxy_pidfile: (optional) the pid file your ezproxy writes. if set, we wait for a new pid in it',
+                    '#                  after a restart, in addition to the port and login page answering. without it,',
+                    '#                  an old ezproxy that is still shutting down can pass for the restarted one',
+                    '# restart_timeout: how many seconds to wait for ezproxy to be ready after a restart',
+                    '# metrics_file: (optional) where to write timings and counts of each run for the textfile collector',
+                    '#               of the Prometheus node exporter, e.g. /var/lib/node_exporter/grabrena.prom',
+                    '# run_report: write the same numbers (and more) to run_report.json in the state_dir',
+                    '# profile: (optional) ";"-separated list of "cprofile" (main thread only) and "tracemalloc",',
+                    '#          their results are written to profile.pstats / tracemalloc.txt in the state_dir',
+                    '# cookie_name: name of the cookie your ezproxy sets for authentication',
+                    '# fetch_workers: how many collections to request from ReNa at the same time',
+                    '# state_dir: where to keep data between runs (HTTP validators, digests, ...), not web accessible',
+                    '# delta_history: how many versions of patch files to keep per collection, 0 to not write any',
+                    '# precompress: write precompressed variants of the JSON files, ";"-separated list of "gz" and "br"',
+                    '#              (br requires the brotli python module). leave empty to write uncompressed files only',
+                    '# hashed_filenames: put a content hash into the name of each collection file, so browsers and caches',
+                    '#                   can keep them forever. setlist.json lists the current names',
+                    '# menu_pack: also write menupack.json, which contains the setlist and all collections',
+                    '# resource_table: put each entry into a resources.<hash>.json file once, and have collection files',
+                    '#                 refer to them by ReNa record id, instead of repeating entries in each collection',
+                    '# daemon_interval: when running with --daemon, sync every this many seconds',
+                    '# retries: how often to try again when a request to ReNa fails with a network error or 5xx answer',
+                    '# retry_backoff: seconds to wait (at most, the actual wait is random) before the first retry,',
+                    '#                doubled for each one after that',
+                    '# request_timeout: seconds to wait for ReNa to connect or send the next bit of a response',
+                    '# collection_timeout: seconds a collection may take, all tries included. a collection that fails',
+                    '#                     keeps its previous file and setlist entry',
+                    '# error_budget: share of collections that may fail before we give up on the rest of them.',
+                    '#               what we got until then is still published, but the run counts as failed',
+                    '# retire_grace: seconds to keep files that are no longer in use, for browsers that still have',
+                    '#               a setlist referring to them',
+                    '# highlight1: (optional) ";"-separated list of hosts (e.g. jstor.org) or host names (jstor) whose',
+                    '#             entries get the highlight1 flag',
+                    '# rewrite_covered: send users to entries ReNa has unproxied through the EZProxy login (login?qurl=...),',
+                    '#                  if there is a stanza in eres_path for their host. changes the links in the menu',
+                    '# page_size: collections with more entries are split into pages of about this many entries,',
+                    '#            by title. browsers load the first page with the menu, the others when they are opened.',
+                    '#            0 to never split collections',
+                    '# facet_fields: (optional) ";"-separated list of ReNa fields to carry over into the menu entries,',
+                    '#               e.g. genre;topic;language;subject_txt_mv;prov_txt_mv. their values go into a',
+                    '#               facets.<hash>.json table once, entries refer to them by index',
+                    '# search_index: write search.<hash>.json, an index of the words in the titles of all entries,',
+                    '#               which the search field of the menu uses',
+                    '# target_workers: how many processes to run targets in, see below',
+                    '#',
+                    '## to write menus for several institutes or EZProxy installations in one go, add a section',
+                    '## [target <name>] for each, with the keys that differ from [grabrena] (at least js_outdir and',
+                    '## state_dir). targets with the same proxy_hostname and username share a login and the',
+                    '## collections they have in common. the eResources.txt settings of such a group are taken',
+                    '## from its first target',
+                    '']))
+        raise GrabrenaError('No config found, please edit the file we created for you')
+    grcfg = config['grabrena']
+    if grcfg['proxy_login_port'] != '' and ':' not in grcfg['proxy_login_port']:
+        grcfg['proxy_login_port'] = ''.join([':', str(grcfg['proxy_login_port'])])
+    if grcfg.getboolean('use_https'):
+        RENA_URL = 'https://rena-mpdl-mpg-de.{0}{1}/rena/'.format(grcfg['proxy_hostname'], grcfg['proxy_login_port'])
+        PROTO = PROTO_HTTPS
+    else:
+        RENA_URL = 'http://rena.mpdl.mpg.de.{0}{1}/rena/'.format(grcfg['proxy_hostname'], grcfg['proxy_login_port'])
+        PROTO = PROTO_HTTP
+    FULLCATALOG_ITEM = {
+        'id': 'Everything',
+        'name': 'Everything',
+        'url': ''.join([RENA_URL, 'Search/Results?lookfor=&type=AllFields']),
+        'logo': 'two'
+    }
+    return grcfg
+
 
 # ~~~ IF CONFIGURED, CHECK TRAVELMAGIC SVN REPO FOR UPDATES ~~~
-if grcfg['svn_up_path'] is not None and grcfg['svn_up_path'] is not '':
+def svn_update():
+    '''if configured, svn up the eResources file, returns True if there were updates'''
     got_svn_update = False
+    if grcfg['svn_up_path'] is None or grcfg['svn_up_path'] == '':
+        return got_svn_update
     try:
         print('Running Subversion on configured repository directory...')
-        print(''.join(['--- output from running "svn up ', grcfg['svn_up_path'], '" ---']))
         if grcfg['svn_opt_cfgdir'] is None or grcfg['svn_opt_cfgdir'] == '':
             svn_command = ['svn', 'up',
                            grcfg['svn_up_path']]
@@ -383,8 +1867,9 @@ if grcfg['svn_up_path'] is not None and grcfg['svn_up_path'] is not '':
                            '--config-dir', grcfg['svn_opt_cfgdir'],
                            grcfg['svn_up_path']]
         svn_output = subprocess.check_output(' '.join(svn_command), shell=True, universal_newlines=True)
-        print(svn_output)
-        print('--- end subprocess output ---')
+        # in one piece, other phases are printing while svn runs
+        print(''.join(['--- output from running "svn up ', grcfg['svn_up_path'], '" ---\n',
+                       svn_output, '\n--- end subprocess output ---']))
         if 'Updated to revision' in svn_output:
             print('Checked TravelMagic repository, and we got new data!')
             got_svn_update = True
@@ -393,8 +1878,8 @@ if grcfg['svn_up_path'] is not None and grcfg['svn_up_path'] is not '':
         else:
             print('WARNING: Checked TravelMagic repository, but something seems off. Please check output above')
     except subprocess.CalledProcessError as e:
-        print(e.output)
-        print('--- end subprocess output ---')
+        print(''.join(['--- output from running "svn up ', grcfg['svn_up_path'], '" ---\n',
+                       e.output, '\n--- end subprocess output ---']))
         print('ERROR: Subversion exited with non-zero status code. Something went wrong!')
         if e.returncode == 127:
             print('\tPlease make sure that you have Subversion installed.')
@@ -402,181 +1887,902 @@ if grcfg['svn_up_path'] is not None and grcfg['svn_up_path'] is not '':
         elif e.returncode == 1:
             print('\tPlease check your configuration, maybe you need to adjust "svn_up_path" in the ini file?')
         print('(Ignore this if you\'re just using grabrena.py to add Find/Replace codes to a non-repo file)')
+    return got_svn_update
 
-    # ~~~ COPY SUBVERSION DATA TO EZPROXY INSTALLATION, ADD OUR JAVASCRIPT INJECTION CODE ~~~
-    if got_svn_update or grcfg.getboolean('force_eRes_update'):
+
+def install_eresources(got_svn_update):
+    '''copy the eResources file from svn to eres_path, adding our javascript injection code
+
+only if svn_update() got new data, force_eRes_update is set or the script injection_file
+points to has changed. returns True if eres_path was replaced'''
+    if grcfg['svn_up_path'] is None or grcfg['svn_up_path'] == '':
+        return False
+    # earlier runs did not record the URL, they used injection_url as it is
+    installed_url = load_state('eresources_index.json').get('injection_url', grcfg['injection_url'])
+    inj_url = versioned_injection_url(installed_url)
+    if inj_url != installed_url:
+        print('The injected script has changed')
+    elif not got_svn_update and not grcfg.getboolean('force_eRes_update'):
+        return False
+    print('Adding injection code to eResources.txt...')
+    eres_changed = write_eresources(grcfg['svn_up_path'], grcfg['eres_path'], inj_url)
+    if eres_changed:
+        print('Updated eResources.txt, EZPROXY RESTART REQUIRED!')
+    else:
+        metrics.file_skipped(grcfg['eres_path'])
+        print('Skipping EZProxy restart')
+    return eres_changed
+
+
+def restart_if_needed(eres_changed):
+    '''restart EZProxy if eres_changed and we know how to, returns True if it was restarted, which ends all sessions'''
+    restarted = False
+    # TODO(krugar): send email to admin and quit if no executable configured
+    if eres_changed and grcfg['ezproxy_executable'] is not None and grcfg['ezproxy_executable'] != '':
+        restarted = True
         try:
-            inj_url = grcfg['injection_url']
-            with ERessourcesFile(grcfg['svn_up_path'], 'r') as repofile, open(grcfg['eres_path'], 'w') as configfile:
-                for stanza in repofile:
-                    stanza.add_injection(inj_url)
-                    configfile.write(str(stanza))
-            print('Updated eResources.txt, EZPROXY RESTART REQUIRED!')
-            # TODO(krugar): send email to admin and quit if no executable configured
-            if grcfg['ezproxy_executable'] is not None and grcfg['ezproxy_executable'] is not '':
-                print('Restarting EZProxy with new configuration')
-                print(''.join(['--- output from running "', grcfg['ezproxy_executable'], ' restart" ---']))
-                restart_command = [grcfg['ezproxy_executable'], 'restart']
-                restart_output = subprocess.check_output(' '.join(restart_command), shell=True, universal_newlines=True)
-                print(restart_output)
-                print('--- end subprocess output ---')
-                print('sleeping for 10 seconds to allow EZProxy to start up...')
-                # TODO(krugar): check if presence of the charge process in pidfile is sufficient for continuation
-                time.sleep(10)
-                print('...continuing')
-        except Exception as e:
+            restart_ezproxy()
+        except RestartError as e:
+            print(''.join(['ERROR: ', e.message]))
+        except subprocess.CalledProcessError as e:
             print(e.output)
+    return restarted
 
 
 # ~~~ COMPOSE MENU FROM PROXIED RENA DATA ~~~
-with requests.Session() as s:
-    # ~~~ LOG IN TO EZPROXY ~~~
+def new_session():
+    '''a requests.Session with a connection pool large enough for all fetch workers'''
+    session = requests.Session()
+    # all fetch workers share this session (and thus the login cookie), give each a pooled connection
+    fetch_workers = max(1, grcfg.getint('fetch_workers'))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers)
+    session.mount(PROTO_HTTP, adapter)
+    session.mount(PROTO_HTTPS, adapter)
+    return session
+
+
+def login(session):
+    '''log in to EZProxy, unless session still holds an unexpired session cookie
+
+returns True if we had to log in, raises LoginError if that failed'''
+    session.cookies.clear_expired_cookies()
+    if grcfg['cookie_name'] in session.cookies.keys():
+        return False
     creds = {'user': grcfg['username'], 'pass': grcfg['password'], 'url': '^U'}
     login_url = ''.join([PROTO, grcfg['proxy_hostname'], grcfg['proxy_login_port'], '/login'])
-    r0 = s.post(login_url, data=creds, allow_redirects=False)
-    if (r0.status_code == 302) and (s.cookies is not None) and (grcfg['cookie_name'] in s.cookies.keys()):
+    r0 = session.post(login_url, data=creds, allow_redirects=False, timeout=grcfg.getfloat('request_timeout'))
+    if (r0.status_code == 302) and (session.cookies is not None) and (grcfg['cookie_name'] in session.cookies.keys()):
         print(''.join(['Logged in to EZProxy "', grcfg['proxy_hostname'], '" as user "', grcfg['username'], '"']))
-        # print(r0.status_code, s.cookies.keys(), r0.headers)
+        # print(r0.status_code, session.cookies.keys(), r0.headers)
     else:
         raise LoginError(''.join(['Failed to log in, received no session cookie. HTTP Status: ', str(r0.status_code)]))
+    return True
+
+
+def logout(session):
+    '''be a good user and log out of EZProxy'''
+    # TODO(krugar): handle all possibly raised errors gracefully
+    r3 = session.get(''.join([PROTO, grcfg['proxy_hostname'], grcfg['proxy_login_port'], '/logout']),
+                     timeout=grcfg.getfloat('request_timeout'))
+    r3.raise_for_status()
+    session.cookies.clear()
+    print(''.join(['Logged out from "', grcfg['proxy_hostname'], '"']))
+
+
+def fetch_setlist(session, collection_state):
+    '''grab the list of collections from ReNa (PredefinedSets), fall back to the one on disk
+
+compares both lists and removes the files of collections that are gone. returns the new
+and the old list as OrderedDicts by id, and whether setlist.json needs to be written'''
+    paramlist = {'inst': grcfg['institute']}
+    need_to_write_setlist = False
+    rena_setdict = collections.OrderedDict()
+    old_setdict = collections.OrderedDict()
+    print('Requesting Collection List from ReNa...')
+    def attempt():
+        r1 = session.get(
+            ''.join([RENA_URL, 'Ext/PredefinedSets']),
+            params=paramlist,
+            timeout=grcfg.getfloat('request_timeout')
+        )
+        r1.raise_for_status()
+        if session_expired(r1):
+            raise LoginError('EZProxy sent us to its login page, our session has expired')
+        return r1.json()
 
-    # alright, we logged in. make sure we log out again, no matter what goes wrong
     try:
-        # ~~~ GRAB THE LIST OF COLLECTIONS FROM RENA (PredefinedSets)~~~
-        paramlist = {'inst': grcfg['institute']}
-        need_to_write_setlist = False
-        rena_setdict = collections.OrderedDict()
-        old_setdict = collections.OrderedDict()
-        old_setlist = []
-        print('Requesting Collection List from ReNa...')
-        try:
-            r1 = s.get(
-                ''.join([RENA_URL, 'Ext/PredefinedSets']),
-                params=paramlist
-            )
-            r1.raise_for_status()
-            # create a dict so we have IDs to iterate over
-            # exptected data format from ReNa is array of objects
-            # with fields as follows:
-            # id: 'unique 9-digit number as string'
-            # name: 'given name of the collection'
-            # fullName: '<institute shorthand>: <given name of the collection>'
-            # url: 'query url to get this collection from ReNa, w/o view param'
-            for setitem in r1.json():
-                if grcfg['proxy_login_port'] is not None and grcfg['proxy_login_port'] is not '':
-                    urllist = list(urlparse(setitem['url']))
-                    if ':' in urllist[1]:
-                        urllist[1] = ''.join([urllist[1][:urllist[1].find(':')],
-                                              grcfg['proxy_login_port']])
-                    else:
-                        urllist[1] = ''.join([urllist[1], grcfg['proxy_login_port']])
-                    setitem['url'] = urlunparse(urllist)
-                rena_setdict[setitem['id']] = {
-                    'id': setitem['id'],
-                    'url': setitem['url'],
-                    'name': setitem['name'],
-                    'logo': 'one'
-                }
-            if len(rena_setdict) == 0:
-                raise NoSetlistError('Got empty collection list from Rena.'
-                                     ' Have you configured your institute name in grabrena.ini? Aborting')
-            print(''.join(['\tGot fresh data, list has ', str(len(rena_setdict)), ' entries']))
-
-            # add the "Everything" collection, as this is not part of the PredefinedSets
-            rena_setdict[FULLCATALOG_ITEM['id']] = FULLCATALOG_ITEM
-
-        except requests.exceptions.RequestException as e:
-            print('\tOops, network error: ', e.args)
-            print('\ttrying to work with on-disk list...')
-        except Exception as e:
-            print('\tError while requesting data from ReNa: ', e.args)
-        try:
-            with open(''.join([grcfg['js_outdir'], 'setlist.json']), 'r') as setfile:
-                old_setlist = json.load(setfile, object_pairs_hook=collections.OrderedDict)
-                for setitem in old_setlist:
-                    old_setdict[setitem['id']] = setitem
-            print('\tOld setlist file present')
-            # if grabbing the collection list from rena failed, we can try to use the local one
-            if len(rena_setdict) == 0:
-                rena_setdict = old_setdict
-                print(''.join(['\tGoing to try and get collection data for on-disk list (',
-                               str(len(rena_setdict)), ' entries)']))
-        except OSError:
-            print('\tOld setlist file not found, starting from scratch')
-            need_to_write_setlist = True
-            if len(rena_setdict) == 0:
-                raise NoSetlistError('Connection to ReNa failed & no local setlist.json file. Aborting')
+        setlist = with_retries(attempt, time.monotonic() + grcfg.getfloat('collection_timeout'))
+        # create a dict so we have IDs to iterate over
+        # exptected data format from ReNa is array of objects
+        # with fields as follows:
+        # id: 'unique 9-digit number as string'
+        # name: 'given name of the collection'
+        # fullName: '<institute shorthand>: <given name of the collection>'
+        # url: 'query url to get this collection from ReNa, w/o view param'
+        for setitem in setlist:
+            if grcfg['proxy_login_port'] is not None and grcfg['proxy_login_port'] != '':
+                urllist = list(urlparse(setitem['url']))
+                if ':' in urllist[1]:
+                    urllist[1] = ''.join([urllist[1][:urllist[1].find(':')],
+                                          grcfg['proxy_login_port']])
+                else:
+                    urllist[1] = ''.join([urllist[1], grcfg['proxy_login_port']])
+                setitem['url'] = urlunparse(urllist)
+            rena_setdict[setitem['id']] = {
+                'id': setitem['id'],
+                'url': setitem['url'],
+                'name': setitem['name'],
+                'logo': 'one'
+            }
+        if len(rena_setdict) == 0:
+            raise NoSetlistError('Got empty collection list from Rena.'
+                                 ' Have you configured your institute name in grabrena.ini? Aborting')
+        print(''.join(['\tGot fresh data, list has ', str(len(rena_setdict)), ' entries']))
 
-        # ~~~ GET EACH COLLECTION FROM RENA ~~~
-        if len(rena_setdict) > len(old_setdict):
-            print('\tThe list we got from ReNa has new collections')
-            need_to_write_setlist = True
-        elif len(rena_setdict) < len(old_setdict):
-            print('\tThe fresh list we got from ReNa has fewer collections than the one we had on disk. Purging files')
-            need_to_write_setlist = True
-            for old_id in old_setdict.keys():
-                if old_id not in rena_setdict.keys():
-                    os.remove(''.join([grcfg['js_outdir'], old_id, '.json']))
-        for set_id, renaset in rena_setdict.items():
+        # add the "Everything" collection, as this is not part of the PredefinedSets
+        # (a copy, as we're going to add to it)
+        rena_setdict[FULLCATALOG_ITEM['id']] = dict(FULLCATALOG_ITEM)
+
+    except LoginError:
+        raise
+    except requests.exceptions.RequestException as e:
+        print('\tOops, network error: ', e.args)
+        print('\ttrying to work with on-disk list...')
+    except Exception as e:
+        print('\tError while requesting data from ReNa: ', e.args)
+    try:
+        with open(''.join([grcfg['js_outdir'], 'setlist.json']), 'r') as setfile:
+            old_setlist = json.load(setfile, object_pairs_hook=collections.OrderedDict)
+            for setitem in old_setlist:
+                old_setdict[setitem['id']] = setitem
+        print('\tOld setlist file present')
+        # if grabbing the collection list from rena failed, we can try to use the local one
+        if len(rena_setdict) == 0:
+            rena_setdict = old_setdict
+            # setlist.json has no urls, but the manifest remembers them
+            for set_id, setitem in rena_setdict.items():
+                if set_id == FULLCATALOG_ITEM['id']:
+                    setitem['url'] = FULLCATALOG_ITEM['url']
+                elif 'url' in collection_state.get(set_id, {}):
+                    setitem['url'] = collection_state[set_id]['url']
+            print(''.join(['\tGoing to try and get collection data for on-disk list (',
+                           str(len(rena_setdict)), ' entries)']))
+    except OSError:
+        print('\tOld setlist file not found, starting from scratch')
+        need_to_write_setlist = True
+        if len(rena_setdict) == 0:
+            raise NoSetlistError('Connection to ReNa failed & no local setlist.json file. Aborting')
+
+    if len(rena_setdict) > len(old_setdict):
+        print('\tThe list we got from ReNa has new collections')
+        need_to_write_setlist = True
+    elif len(rena_setdict) < len(old_setdict):
+        print('\tThe fresh list we got from ReNa has fewer collections than the one we had on disk. Purging files')
+        need_to_write_setlist = True
+        for old_id in old_setdict.keys():
+            if old_id not in rena_setdict.keys():
+                old_state = collection_state.pop(old_id, {})
+                retire_output(old_state.get('file', old_id))
+                for old_page in old_state.get('pages', []):
+                    retire_output(old_page)
+                for old_version in range(old_state.get('base', 0) + 1, old_state.get('version', 0) + 1):
+                    retire_output(''.join([old_id, '.v', str(old_version)]))
+    return rena_setdict, old_setdict, need_to_write_setlist
+
+
+def sync_collections(session, rena_setdict, old_setdict, collection_state, resource_table, facet_table):
+    '''get each collection from ReNa and write the ones that changed
+
+updates rena_setdict and collection_state in place. returns whether setlist.json
+needs to be written, the collections written by id, the files they replace and the ids
+of the collections that failed. those keep their previous file and setlist entry (new ones
+are left out), once more than error_budget of them failed, the rest are not requested at all'''
+    need_to_write_setlist = False
+    use_table = grcfg.getboolean('resource_table')
+    page_size = max(0, grcfg.getint('page_size'))
+    # entries depend on the hosts EZProxy proxies and our flags for them, not only on what ReNa says.
+    # if these changed, a 304 from ReNa would keep stale proxied and highlight1 values
+    hosts = host_index if host_index is not None else HostIndex(grcfg['proxy_hostname'], grcfg['highlight1'])
+    classified_by = ''.join([hosts.fingerprint(), ' rewrite_covered=', str(grcfg.getboolean('rewrite_covered'))])
+    fields = ';'.join(facet_fields())
+    # only ask ReNa whether a collection changed if we still have what we got last time,
+    # in the format we want
+    set_validators = {}
+    for set_id in rena_setdict.keys():
+        cached = collection_state.get(set_id)
+        if (cached is not None and (cached.get('etag') or cached.get('last_modified'))
+                and set_id in old_setdict and cached.get('refs', False) == use_table
+                and cached.get('page_size', 0) == paged_by(cached.get('entries', 0), page_size)
+                and cached.get('facets', '') == fields and not facet_table.lost
+                and cached.get('facet_generation', 0) == facet_table.generation
+                and cached.get('classified_by') == classified_by
+                and os.path.exists(output_path(cached.get('file', set_id)))):
+            set_validators[set_id] = cached
+    # files replaced by ones with a new name, to be removed once the new setlist is in place
+    stale_files = []
+    # collections we wrote during this run, by id
+    new_collections = {}
+    # created up front, so the worker threads don't need to touch metrics.collections
+    set_stats = dict((set_id, metrics.collection(set_id)) for set_id in rena_setdict.keys())
+    # query ReNa for all collections concurrently. results are handled in setlist order,
+    # so output and setlist.json are the same as if we went through them one by one
+    failed = []
+    max_failed = int(grcfg.getfloat('error_budget') * len(rena_setdict))
+    with ThreadPoolExecutor(max_workers=max(1, grcfg.getint('fetch_workers'))) as fetch_pool:
+        set_items = list(rena_setdict.items())
+        fetch_futures = [fetch_pool.submit(fetch_shared, session, renaset,
+                                           set_validators.get(set_id), set_stats[set_id])
+                         if 'url' in renaset else None
+                         for set_id, renaset in set_items]
+        for (set_id, renaset), fetch_future in zip(set_items, fetch_futures):
             print(''.join(['Requesting Data for Collection "', renaset['name'], '"...']))
-            old_json = None
+            stats = set_stats[set_id]
+            if fetch_future is None:
+                # from the on-disk setlist, and written before we kept urls in the manifest
+                print('\tDon\'t know where to get this one, keeping the previous version')
+                stats['status'] = 'kept'
+                metrics.file_skipped(renaset.get('file', set_id))
+                continue
+            try:
+                data_list, record_ids, validators, messages = fetch_future.result()
+            except LoginError:
+                for other_future in fetch_futures:
+                    if other_future is not None:
+                        other_future.cancel()
+                raise
+            except CancelledError:
+                print('\tSkipped, too many collections failed already')
+                data_list = False
+            except Exception as e:
+                print(''.join(['\tFailed after ', str(stats.get('tries', 1)), ' tries: ', type(e).__name__, ': ', str(e)]))
+                data_list = False
+            if data_list is False:
+                failed.append(set_id)
+                stats['status'] = 'failed'
+                if len(failed) == max_failed + 1:
+                    print(''.join(['\tThat is more than error_budget allows (', str(max_failed),
+                                   '), not requesting any more collections']))
+                    for other_future in fetch_futures:
+                        if other_future is not None:
+                            other_future.cancel()
+                # leave what we have on disk for this one alone
+                if set_id in old_setdict:
+                    print('\tKeeping the previous version')
+                    rena_setdict[set_id] = old_setdict[set_id]
+                    metrics.file_skipped(old_setdict[set_id].get('file', set_id))
+                else:
+                    del rena_setdict[set_id]
+                continue
+            if data_list is None:
+                # 304 Not Modified, no need to download, parse or hash anything
+                print('\tReNa reports no changes, local data is still good')
+                rena_setdict[set_id] = old_setdict[set_id]
+                stats['status'] = 'not modified'
+                metrics.file_skipped(set_validators[set_id].get('file', set_id))
+                continue
+            if fields != '':
+                # a copy, data_list may be shared with other targets (see fetch_shared())
+                data_list = [facet_table.encode(entry) for entry in data_list]
             old_digest = None
+            cached = collection_state.get(set_id, {})
             try:  # check local file for this collection
-                with open(''.join([grcfg['js_outdir'], set_id, '.json']), 'r') as old_file:
-                    old_json = json.load(old_file, object_pairs_hook=collections.OrderedDict)
-                # only hash over the data originally retrieved from ReNa, not the metadata
-                old_digest = json_hexdigest(old_json['data'])
+                old_name = cached.get('file', set_id)
+                outfile_size = os.path.getsize(output_path(old_name))
+                if 'size' in cached and cached['size'] == outfile_size:
+                    # the manifest still describes the file on disk, no need to read it
+                    old_digest = cached['digest']
+                else:
+                    with open(output_path(old_name), 'r') as old_file:
+                        old_json = json.load(old_file, object_pairs_hook=collections.OrderedDict)
+                    # only hash over the data originally retrieved from ReNa, not the metadata
+                    with RunMetrics.timed(stats, 'hash_seconds'):
+                        if 'pages' in old_json:
+                            # paged files have all entries sorted by title across their pages (see paginate()),
+                            # so compare with what we got in that order
+                            try:
+                                old_paged_digest = json_hexdigest(written_entries(old_json, resource_table))
+                            except OSError:
+                                print('\tA page of the local copy is missing')
+                                old_paged_digest = ''
+                            new_paged_digest = json_hexdigest(sorted(data_list,
+                                                                     key=lambda entry: entry['title'].casefold()))
+                            old_digest = json_hexdigest(data_list) if old_paged_digest == new_paged_digest else ''
+                        else:
+                            old_digest = json_hexdigest(collection_entries(old_json, resource_table))
             except OSError:
                 print("\tWe don't have a local copy of this one yet")
+            except KeyError:
+                print('\tLocal copy refers to entries missing from the resource table')
+                old_digest = ''
+            # files with refs need to be rewritten with data and vice versa, same with pages and facets
+            format_changed = old_digest is not None and (cached.get('refs', False) != use_table
+                                                         or cached.get('page_size', 0) != paged_by(len(data_list), page_size)
+                                                         or cached.get('facets', '') != fields or facet_table.lost
+                                                         or cached.get('facet_generation', 0) != facet_table.generation)
 
-            # query ReNa for this collection
-            r2 = s.get(renaset['url'], params={'view': 'JSON'})
-            r2.raise_for_status()
-            newdata_json = r2.json()
+            for line in messages:
+                print(line)
             timestamp = str(int(time.time()))
-            data_list = good_rena_entries_to_array(newdata_json)
-            new_digest = json_hexdigest(data_list)
+            with RunMetrics.timed(stats, 'hash_seconds'):
+                new_digest = json_hexdigest(data_list)
             new_data = collections.OrderedDict()
             new_data['name'] = renaset['name']
             new_data['id'] = set_id
-            new_data['data'] = data_list
+            if use_table:
+                new_data['refs'] = [resource_table.add(record_id, entry)
+                                    for record_id, entry in zip(record_ids, data_list)]
+            else:
+                new_data['data'] = data_list
+            cached['url'] = renaset['url']
+            cached['etag'] = validators['etag']
+            cached['last_modified'] = validators['last_modified']
+            cached['digest'] = new_digest
+            cached['classified_by'] = classified_by
+            if fields != '':
+                cached['facets'] = fields
+                cached['facet_generation'] = facet_table.generation
+            else:
+                cached.pop('facets', None)
+                cached.pop('facet_generation', None)
+            collection_state[set_id] = cached
 
             # update/create local file for this collection
-            if old_digest != new_digest:
+            if old_digest != new_digest or format_changed:
                 need_to_write_setlist = True
+                stats['status'] = 'changed'
+                old_version = cached.get('version', 0)
+                old_base = cached.get('base', old_version)
+                # without a manifest entry (a new collection, or state_dir got lost), versions start from the
+                # clock. patch files are named by version, and browsers may have cached ones written before
+                version = old_version + 1 if 'version' in cached else int(time.time())
+                new_data['version'] = version
+                old_pages = cached.get('pages', [])
+                new_pages = []
+                if paged_by(len(data_list), page_size) > 0:
+                    new_data, page_files = paginate(new_data, data_list, page_size)
+                    for page_name, page_data in page_files:
+                        new_pages.append(page_name)
+                        if page_name in old_pages and os.path.exists(output_path(page_name)):
+                            # pages are named after their content
+                            metrics.file_skipped(page_name)
+                        else:
+                            with RunMetrics.timed(stats, 'write_seconds'):
+                                write_output(page_name, page_data)
+                    print(''.join(['\tSplit into ', str(len(new_data['pages'])), ' pages of at most ',
+                                   str(page_size), ' entries']))
+                stale_files.extend(page_name for page_name in old_pages if page_name not in new_pages)
+                new_raw = MINIFIED_JSON.encode(new_data).encode('utf-8')
+                delta = None
                 if old_digest is not None:
-                    print('\tData from ReNa differs from local copy, updating')
-                with open(''.join([grcfg['js_outdir'], set_id, '.json']), 'w') as out:
-                    json.dump(new_data, out)
-                if set_id in rena_setdict:
-                    # this was an update to a collection we knew about
-                    rena_setdict[set_id]['timestamp'] = timestamp
-                else:
-                    # this was a new collection, remember new timestamp
+                    if format_changed:
+                        print('\tLocal copy is not in the configured format (see resource_table, page_size, facet_fields),'
+                              ' rewriting')
+                    else:
+                        print('\tData from ReNa differs from local copy, updating')
+                    stale_files.append(old_name)
+                    # patches don't work across pages, browsers get changed pages by their new names instead
+                    if (old_version > 0 and grcfg.getint('delta_history') > 0 and not format_changed
+                            and len(old_pages) == 0 and len(new_pages) == 0):
+                        try:
+                            with open(output_path(old_name), 'r') as old_file:
+                                old_json = json.load(old_file, object_pairs_hook=collections.OrderedDict)
+                            if use_table:
+                                delta = collection_delta(old_json['refs'], new_data['refs'])
+                            else:
+                                delta = collection_delta(old_json['data'], data_list)
+                        except (OSError, ValueError, KeyError):
+                            delta = None
+                base = version
+                if delta is not None:
+                    # browsers with one of the versions since base cached can patch up to this version
+                    patch = collections.OrderedDict([('id', set_id), ('from', old_version), ('to', version)])
+                    patch.update(delta)
+                    if len(MINIFIED_JSON.encode(patch)) >= len(new_raw):
+                        # no point in patching if the whole thing is smaller
+                        delta = None
+                if delta is not None:
+                    with RunMetrics.timed(stats, 'write_seconds'):
+                        write_output(''.join([set_id, '.v', str(version)]), patch)
+                    base = max(old_base, version - grcfg.getint('delta_history'))
+                    print(''.join(['\tWrote patch from version ', str(old_version), ' to ', str(version),
+                                   ' (', str(len(delta['added'])), ' added, ', str(len(delta['removed'])),
+                                   ' removed, ', str(len(delta['modified'])), ' modified)']))
+                # remove patches that lead up to versions older than base
+                for old_patch in range(old_base + 1, min(base, old_version) + 1):
+                    retire_output(''.join([set_id, '.v', str(old_patch)]))
+                new_name = hashed_name(set_id, new_raw)
+                with RunMetrics.timed(stats, 'write_seconds'):
+                    write_output(new_name, new_raw)
+                new_collections[set_id] = new_data
+                if new_name in stale_files:
+                    stale_files.remove(new_name)
+                cached['file'] = new_name
+                cached['size'] = len(new_raw)
+                cached['timestamp'] = timestamp
+                cached['version'] = version
+                cached['base'] = base
+                cached['refs'] = use_table
+                cached['entries'] = len(data_list)
+                cached['page_size'] = paged_by(len(data_list), page_size)
+                cached['pages'] = new_pages
+                if set_id not in rena_setdict:
+                    # this was a new collection
                     rena_setdict[set_id] = {
                         'id': set_id,
-                        'timestamp': timestamp,
                         'name': renaset['name']
                     }
-            elif old_digest is not None and old_setdict[set_id] is not None:
+                # remember new timestamp and version
+                rena_setdict[set_id]['timestamp'] = timestamp
+                rena_setdict[set_id]['version'] = version
+                rena_setdict[set_id]['base'] = base
+                rena_setdict[set_id]['file'] = new_name
+            elif old_setdict.get(set_id) is not None:
                 # no difference in digests, collection hasn't changed
                 # keep the old metadata/timestamp
                 print('\tLocal data is still good')
+                stats['status'] = 'unchanged'
+                metrics.file_skipped(old_name)
                 rena_setdict[set_id] = old_setdict[set_id]
+                cached['size'] = outfile_size
+                cached['timestamp'] = old_setdict[set_id].get('timestamp')
+            else:
+                # unchanged, but the setlist lost track of it
+                need_to_write_setlist = True
+                stats['status'] = 'unchanged'
+                metrics.file_skipped(old_name)
+                rena_setdict[set_id]['timestamp'] = cached.get('timestamp') or timestamp
+                cached['size'] = outfile_size
+                cached['timestamp'] = rena_setdict[set_id]['timestamp']
+                if 'version' in cached:
+                    rena_setdict[set_id]['version'] = cached['version']
+                    rena_setdict[set_id]['base'] = cached['base']
+                rena_setdict[set_id]['file'] = old_name
+    metrics.gauges['failed_collections'] = len(failed)
+    return need_to_write_setlist, new_collections, stale_files, failed
+
+
+def update_search_index(rena_setdict, new_collections, collection_state, resource_table):
+    '''write the search index for the collections in rena_setdict if it changed
+
+the postings of each collection are kept in state_dir, and only built again for collections
+that were written (or whose file changed) since. returns the name of the index file and the
+state to save, None if nothing changed'''
+    search_state = load_state('search.json')
+    old_postings = search_state.get('collections', {})
+    new_state = collections.OrderedDict([('file', search_state.get('file')), ('collections', collections.OrderedDict())])
+    set_postings = collections.OrderedDict()
+    rebuilt = 0
+    for set_id, setlist_item in rena_setdict.items():
+        cached = collection_state.get(set_id, {})
+        # what the postings were built from
+        source = [setlist_item.get('file', set_id), cached.get('version', 0)]
+        old = old_postings.get(set_id, {})
+        if set_id not in new_collections and old.get('source') == source:
+            set_postings[set_id] = old['postings']
+        else:
+            try:
+                collection = new_collections.get(set_id) or read_output(setlist_item.get('file', set_id))
+                set_postings[set_id] = search_postings(written_entries(collection, resource_table))
+            except (OSError, ValueError, KeyError):
+                print(''.join(['\tCould not read collection ', set_id, ', leaving it out of the search index']))
+                set_postings[set_id] = {}
+            rebuilt += 1
+        new_state['collections'][set_id] = collections.OrderedDict([('source', source),
+                                                                     ('postings', set_postings[set_id])])
+    if (rebuilt == 0 and list(rena_setdict.keys()) == list(old_postings.keys())
+            and search_state.get('file') is not None and os.path.exists(output_path(search_state['file']))):
+        metrics.file_skipped(search_state['file'])
+        return search_state['file'], None
+    index = merge_search_postings(list(rena_setdict.keys()), set_postings)
+    index_raw = MINIFIED_JSON.encode(index).encode('utf-8')
+    # always hashed, the name doubles as version of the index in browser storage
+    name = '.'.join(['search', hashlib.sha256(index_raw).hexdigest()[:12]])
+    if name == search_state.get('file') and os.path.exists(output_path(name)):
+        metrics.file_skipped(name)
+    else:
+        file_raw = write_output(name, collections.OrderedDict([('file', name), ('index', index)]))
+        metrics.gauges['search_index_terms'] = len(index['terms'])
+        metrics.gauges['search_index_bytes'] = len(file_raw)
+        print(''.join(['Updated search index, ', str(len(index['terms'])), ' terms in ', str(len(file_raw)),
+                       ' bytes (rebuilt the postings of ', str(rebuilt), ' of ', str(len(set_postings)),
+                       ' collections)']))
+    new_state['file'] = name
+    return name, new_state
+
+
+def publish(rena_setdict, new_collections, stale_files, need_to_write_setlist, collection_state, resource_table,
+            facet_table):
+    '''write resource and facet table, setlist and menu pack if needed, put them live, retire stale files and save state'''
+    use_table = grcfg.getboolean('resource_table')
+    use_facets = len(facet_fields()) > 0
+    use_search = grcfg.getboolean('search_index')
+    resources_state = None
+    facets_state = None
+    search_name = None
+    search_state = None
+    for setlist_item in rena_setdict.values():
+        if 'url' in setlist_item:
+            del setlist_item['url']
+    if use_table and (need_to_write_setlist or resource_table.name is None
+                      or not os.path.exists(output_path(resource_table.name))):
+        print('Updating resource table...')
+        all_refs = []
+        for set_id, setlist_item in rena_setdict.items():
+            if set_id in new_collections:
+                all_refs.append(collection_refs(new_collections[set_id]))
             else:
-                need_to_write_setlist = True  # just making sure
-        if need_to_write_setlist:
-            # only write this file when there were changes to minimize cache invalidations
-            # write out an array of values, the keys are only useful while we work on the data here
-            for setlist_item in rena_setdict.values():
-                if 'url' in setlist_item:
-                    del setlist_item['url']
-            with open(''.join([grcfg['js_outdir'], 'setlist.json']), 'w') as out2:
-                json.dump(list(rena_setdict.values()), out2)
-
-    finally:  # be a good user and log out of EZProxy no matter what
-        # ~~~ LOG OUT OF EZPROXY ~~~
-        # TODO(krugar): handle all possibly raised errors gracefully
-        r3 = s.get(''.join([PROTO, grcfg['proxy_hostname'], grcfg['proxy_login_port'], '/logout']))
-        r3.raise_for_status()
-        print(''.join(['Logged out from "', grcfg['proxy_hostname'], '"']))
+                all_refs.append(collection_refs(read_output(setlist_item.get('file', set_id))))
+        old_table_name = resource_table.name
+        resource_table.prune(set(ref for refs in all_refs for ref in refs))
+        table_raw = resource_table.write()
+        if old_table_name is not None and old_table_name != resource_table.name:
+            stale_files.append(old_table_name)
+        resources_state = {'file': resource_table.name}
+        inline_size = sum(len(MINIFIED_JSON.encode(resource_table.resolve(refs))) for refs in all_refs)
+        refs_size = sum(len(MINIFIED_JSON.encode(refs)) for refs in all_refs)
+        metrics.gauges['resource_table_entries'] = len(resource_table.entries)
+        metrics.gauges['resource_table_bytes'] = len(table_raw)
+        print(''.join(['\t', str(len(resource_table.entries)), ' distinct entries for ',
+                       str(sum(len(refs) for refs in all_refs)), ' collection entries: ',
+                       str(len(table_raw) + refs_size), ' bytes (table ', str(len(table_raw)), ', refs ',
+                       str(refs_size), ') instead of ', str(inline_size), ' bytes inline']))
+    elif not use_table and resource_table.name is not None:
+        # all collections have been rewritten with data by now
+        stale_files.append(resource_table.name)
+        resources_state = {}
+    if use_facets and (facet_table.changed or facet_table.name is None
+                       or not os.path.exists(output_path(facet_table.name))):
+        old_facets_name = facet_table.name
+        facets_raw = facet_table.write()
+        if old_facets_name is not None and old_facets_name != facet_table.name:
+            stale_files.append(old_facets_name)
+        facets_state = {'file': facet_table.name, 'generation': facet_table.generation}
+        metrics.gauges['facet_table_values'] = sum(len(field_values) for field_values in facet_table.values.values())
+        metrics.gauges['facet_table_bytes'] = len(facets_raw)
+        print(''.join(['Updated facet table, ', str(metrics.gauges['facet_table_values']), ' values in ',
+                       str(len(facets_raw)), ' bytes']))
+        # values are never taken out, the table only gets smaller by starting over
+        unused = facet_table.unused(
+            entry for set_id, setlist_item in rena_setdict.items()
+            for entry in written_entries(new_collections[set_id] if set_id in new_collections
+                                         else read_output(setlist_item.get('file', set_id)), resource_table))
+        metrics.gauges['facet_table_unused'] = unused
+        if unused > FACET_COMPACT_SHARE * metrics.gauges['facet_table_values']:
+            print(''.join(['\t', str(unused), ' of them are not used any more, rebuilding the table next run']))
+            facets_state['compact'] = True
+    elif not use_facets and facet_table.name is not None:
+        # all collections have been rewritten without facets by now
+        stale_files.append(facet_table.name)
+        facets_state = {}
+    old_search_name = load_state('search.json').get('file')
+    if use_search:
+        search_name, search_state = update_search_index(rena_setdict, new_collections, collection_state,
+                                                        resource_table)
+    elif old_search_name is not None:
+        search_state = {}
+    if old_search_name is not None and old_search_name != search_name:
+        stale_files.append(old_search_name)
+    for setlist_item in rena_setdict.values():
+        if use_table and setlist_item.get('resources') != resource_table.name:
+            setlist_item['resources'] = resource_table.name
+            need_to_write_setlist = True
+        elif not use_table and 'resources' in setlist_item:
+            del setlist_item['resources']
+            need_to_write_setlist = True
+        if use_facets and setlist_item.get('facets') != facet_table.name:
+            setlist_item['facets'] = facet_table.name
+            need_to_write_setlist = True
+        elif not use_facets and 'facets' in setlist_item:
+            del setlist_item['facets']
+            need_to_write_setlist = True
+        if use_search and setlist_item.get('search') != search_name:
+            setlist_item['search'] = search_name
+            need_to_write_setlist = True
+        elif not use_search and 'search' in setlist_item:
+            del setlist_item['search']
+            need_to_write_setlist = True
+    if need_to_write_setlist:
+        # only write this file when there were changes to minimize cache invalidations
+        # write out an array of values, the keys are only useful while we work on the data here
+        write_output('setlist', list(rena_setdict.values()))
+    else:
+        metrics.file_skipped('setlist')
+    if grcfg.getboolean('menu_pack') and (need_to_write_setlist or not os.path.exists(output_path('menupack'))):
+        print('Writing menu pack...')
+        pack_raw = write_menu_pack(list(rena_setdict.values()), new_collections,
+                                   resource_table if use_table else None, facet_table if use_facets else None)
+        metrics.gauges['menupack_bytes'] = len(pack_raw)
+        print(''.join(['\tmenupack.json has ', str(len(pack_raw)), ' bytes']))
+    elif grcfg.getboolean('menu_pack'):
+        metrics.file_skipped('menupack')
+    for stale_name in stale_files:
+        retire_output(stale_name)
+    print(''.join(['Publishing ', str(len(commit_output())), ' files']))
+    if resources_state is not None:
+        save_state('resources.json', resources_state)
+    if facets_state is not None:
+        save_state('facets.json', facets_state)
+    if search_state is not None:
+        save_state('search.json', search_state)
+    save_state('collections.json', collection_state)
+
+
+def prepare_sync():
+    '''load what we know from the last run, returns the collection manifest, the ResourceTable and the FacetTable'''
+    # manifest of what we wrote last time, per collection: digest, file size, timestamp
+    # and the HTTP validators (ETag, Last-Modified) ReNa sent along
+    collection_state = load_state('collections.json')
+    # leftovers of a run that did not get to publish
+    discard_output()
+    # entries shared by all collections. also needed to read collection files written with refs
+    # when resource_table has been switched off since
+    resource_table = ResourceTable(load_state('resources.json').get('file'))
+    # read the table file now, not when the first collection needs it
+    len(resource_table.entries)
+    # the values entries refer to by index, also needed to notice the table got lost
+    facets_state = load_state('facets.json')
+    facet_table = FacetTable(facets_state.get('file'), facets_state.get('generation', 0))
+    len(facet_table.values)
+    if facets_state.get('compact') and len(facet_fields()) > 0:
+        print('Rebuilding the facet table, all collections will be written again')
+        facet_table.rebuild()
+    return collection_state, resource_table, facet_table
+
+
+def sync_menu(session, eresources=False, got_svn_update=None):
+    '''log in if needed, fetch setlist and collections from ReNa through session, publish whatever changed
+
+with eresources, also update eResources.txt and restart EZProxy if needed (see svn_update()),
+svn is not run again if got_svn_update says what it had to say already.
+the phases run in a PhaseScheduler: svn and local preparations run while we log in and get
+the setlist. a restart waits for that to be over, and only the collections wait for the restart.
+the critical path goes into metrics'''
+    scheduler = PhaseScheduler()
+    scheduler.add('prepare', lambda done: prepare_sync(), background=True)
+    if eresources:
+        scheduler.add('svn', lambda done: svn_update() if got_svn_update is None else got_svn_update,
+                      background=True)
+        scheduler.add('eresources', lambda done: install_eresources(done['svn']), after=['svn'], background=True)
+    # needs the eResources.txt we are about to install, if any
+    scheduler.add('hosts', lambda done: load_host_index(), after=['eresources'] if eresources else [],
+                  background=True)
+
+    def setlist_phase(done):
+        collection_state, resource_table, facet_table = done['prepare']
+        return fetch_setlist(session, collection_state)
+
+    def collections_phase(done):
+        if done.get('restart'):
+            # the restart ended our EZProxy session along with the pooled connections
+            session.cookies.clear()
+            session.close()
+            with metrics.phase('login'):
+                login(session)
+        collection_state, resource_table, facet_table = done['prepare']
+        rena_setdict, old_setdict, need_to_write_setlist = done['setlist']
+        set_count = len(rena_setdict)
+        return sync_collections(session, rena_setdict, old_setdict, collection_state, resource_table,
+                                facet_table) + (set_count,)
+
+    def publish_phase(done):
+        collection_state, resource_table, facet_table = done['prepare']
+        rena_setdict, old_setdict, need_to_write_setlist = done['setlist']
+        collections_changed, new_collections, stale_files, failed, set_count = done['collections']
+        publish(rena_setdict, new_collections, stale_files, need_to_write_setlist or collections_changed,
+                collection_state, resource_table, facet_table)
+
+    scheduler.add('login', lambda done: login(session))
+    scheduler.add('setlist', setlist_phase, after=['login', 'prepare'])
+    if eresources:
+        # not while our requests are on their way through EZProxy, but no matter whether they worked out
+        scheduler.add('restart', lambda done: restart_if_needed(done['eresources']), after=['eresources'],
+                      waits=['setlist'], background=True)
+    scheduler.add('collections', collections_phase, after=['setlist', 'hosts'] + (['restart'] if eresources else []))
+    scheduler.add('publish', publish_phase, after=['collections'])
+    try:
+        done = scheduler.run()
+    finally:
+        metrics.critical_path = scheduler.critical_path()
+        metrics.gauges['critical_path_seconds'] = sum(seconds for name, seconds in metrics.critical_path)
+    collections_changed, new_collections, stale_files, failed, set_count = done['collections']
+    if len(failed) > int(grcfg.getfloat('error_budget') * set_count):
+        raise ErrorBudgetError(''.join([str(len(failed)), ' collections failed, more than error_budget allows']))
+    if len(failed) > 0:
+        print(''.join([str(len(failed)), ' collections failed, left them as they were: ',
+                       ', '.join(failed)]))
+
+
+def run_once():
+    '''what a cron job does: update eResources.txt, log in, sync the menu, log out'''
+    begin_run()
+    success = False
+    try:
+        with new_session() as s:
+            # make sure we log out again, no matter what goes wrong
+            try:
+                sync_menu(s, eresources=True)
+            finally:
+                if grcfg['cookie_name'] in s.cookies.keys():
+                    with metrics.phase('logout'):
+                        logout(s)
+        success = True
+    finally:
+        end_run(success)
+
+
+def run_daemon():
+    '''keep one logged in session around and sync every daemon_interval seconds
+
+SIGUSR1 starts a sync right away, SIGTERM and SIGINT log out and end the daemon'''
+    wakeup = threading.Event()
+    stopping = threading.Event()
+
+    def request_sync(signum, frame):
+        wakeup.set()
+
+    def request_stop(signum, frame):
+        stopping.set()
+        wakeup.set()
+
+    signal.signal(signal.SIGUSR1, request_sync)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    print(''.join(['Running as daemon (pid ', str(os.getpid()), '), send SIGUSR1 to sync now']))
+    s = new_session()
+    retry_login = True
+    try:
+        while not stopping.is_set():
+            wakeup.clear()
+            begin_run()
+            success = False
+            try:
+                sync_menu(s, eresources=True)
+                success = True
+                retry_login = True
+            except LoginError as e:
+                print(''.join(['Sync failed: ', e.message]))
+                s.cookies.clear()
+                if retry_login:
+                    # most likely our session expired, log in again right away (but only once)
+                    retry_login = False
+                    continue
+            except Exception as e:
+                # keep running, maybe things are better next time
+                print('Sync failed: ', e.args)
+            finally:
+                end_run(success)
+            if not stopping.is_set():
+                print(''.join(['Next sync in ', grcfg['daemon_interval'], ' seconds']))
+                wakeup.wait(grcfg.getint('daemon_interval'))
+    finally:
+        if grcfg['cookie_name'] in s.cookies.keys():
+            logout(s)
+        s.close()
+
+
+def config_targets(path=configfile):
+    '''names of the [target <name>] sections in the ini file at path'''
+    config = configparser.ConfigParser()
+    with open(path, 'r') as confh:
+        config.read_file(confh)
+    targets = [section[len(TARGET_PREFIX):].strip() for section in config.sections()
+               if section.startswith(TARGET_PREFIX)]
+    if MAIN_TARGET in targets:
+        raise GrabrenaError(''.join(['[', TARGET_PREFIX, MAIN_TARGET, '] is taken, that is what [', MAIN_TARGET,
+                                     '] itself is called among the targets']))
+    return targets
+
+
+def run_target_group(path, targets, svn_updates):
+    '''run targets that share an EZProxy login one after the other. runs in a worker process
+
+the first target also takes care of the eResources.txt of the group (with what svn_update()
+said for its svn_up_path in svn_updates). collections several targets get from the same URL
+are only fetched once, see fetch_shared(). returns the output and the targets that failed'''
+    global shared_fetches
+    shared_fetches = {}
+    output = io.StringIO()
+    failed = []
+    # keep the output of each group in one piece, the others are printing at the same time
+    with contextlib.redirect_stdout(output):
+        try:
+            load_config(path, targets[0])
+            with new_session() as s:
+                try:
+                    for index, target in enumerate(targets):
+                        load_config(path, target)
+                        print(''.join(['~~~ Target "', target, '" ~~~']))
+                        begin_run()
+                        success = False
+                        try:
+                            sync_menu(s, eresources=index == 0, got_svn_update=svn_updates.get(grcfg['svn_up_path']))
+                            success = True
+                        except LoginError:
+                            failed.extend(targets[index:])
+                            raise
+                        except Exception as e:
+                            print('Sync failed: ', e.args)
+                            failed.append(target)
+                        finally:
+                            end_run(success)
+                finally:
+                    if grcfg['cookie_name'] in s.cookies.keys():
+                        logout(s)
+        except Exception as e:
+            print('Giving up on this EZProxy: ', e.args)
+            failed.extend(target for target in targets if target not in failed)
+    shared_fetches = None
+    return output.getvalue(), failed
+
+
+def run_targets(path=configfile):
+    '''sync the menu of [grabrena] and those of all [target <name>] sections of the ini file at path
+
+targets are grouped by EZProxy (proxy_hostname, proxy_login_port, use_https) and user, the
+groups run in a pool of target_workers processes. svn runs here, once per svn_up_path.
+raises GrabrenaError if any target failed, after all of them had their go'''
+    load_config(path)
+    workers = max(1, grcfg.getint('target_workers'))
+    groups = collections.OrderedDict()
+    outdirs = {}
+    # [grabrena] is a menu of its own, not only the defaults of the targets
+    for target in [MAIN_TARGET] + config_targets(path):
+        load_config(path, target)
+        # targets must not write into each other's files
+        for key in ('js_outdir', 'state_dir'):
+            place = (key, os.path.abspath(os.path.expanduser(grcfg[key])))
+            if place in outdirs:
+                raise GrabrenaError(''.join(['Targets "', outdirs[place], '" and "', target, '" use the same ', key]))
+            outdirs[place] = target
+        group = (grcfg['proxy_hostname'], grcfg['proxy_login_port'], grcfg.getboolean('use_https'), grcfg['username'])
+        groups.setdefault(group, []).append(target)
+    # several groups may use the same svn checkout, don't let them run svn on it at the same time
+    svn_updates = {}
+    eres_paths = {}
+    for targets in groups.values():
+        load_config(path, targets[0])
+        if grcfg['svn_up_path'] == '':
+            continue
+        # nor let them install the same file
+        if grcfg['eres_path'] in eres_paths:
+            raise GrabrenaError(''.join(['Targets "', eres_paths[grcfg['eres_path']], '" and "', targets[0],
+                                         '" log in to different EZProxies, but use the same eres_path']))
+        eres_paths[grcfg['eres_path']] = targets[0]
+        if grcfg['svn_up_path'] not in svn_updates:
+            svn_updates[grcfg['svn_up_path']] = svn_update()
+    print(''.join(['Syncing ', str(sum(len(targets) for targets in groups.values())), ' targets with ',
+                   str(len(groups)), ' logins in ', str(min(workers, len(groups))), ' processes']))
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as target_pool:
+        group_futures = [target_pool.submit(run_target_group, path, targets, svn_updates)
+                         for targets in groups.values()]
+        for group_future in group_futures:
+            output, group_failed = group_future.result()
+            print(output, end='')
+            failed.extend(group_failed)
+    if len(failed) > 0:
+        raise GrabrenaError(''.join(['Targets failed: ', ', '.join(failed)]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='grab info from ReNa and make it usable for the menu')
+    parser.add_argument('-c', '--config', default=configfile, help='ini file to use (default: %(default)s)')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='keep running and sync every daemon_interval seconds (see ini file)')
+    parser.add_argument('-t', '--target',
+                        help='only sync the [target TARGET] section of the ini file, or [grabrena] with "grabrena"')
+    args = parser.parse_args(argv)
+    load_config(args.config, args.target)
+    if args.target is None and len(config_targets(args.config)) > 0:
+        if args.daemon:
+            raise GrabrenaError(''.join(['--daemon syncs a single menu, please run one for each target and one for ',
+                                         '[grabrena] (see --target)']))
+        run_targets(args.config)
+    elif args.daemon:
+        run_daemon()
+    else:
+        run_once()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ export interface iSetlistCollectionItemData {
   proxied: boolean;
   free: boolean;
   desc?: string;
+  facets?: Record<string, string[]>;
 }
 export interface iSetlistCollectionItem extends iSetlistCollectionItemData {
   buildElement(data: iSetlistCollectionItem): HTMLLIElement;
@@ -26,6 +27,7 @@ export interface iSetlistCollectionItem extends iSetlistCollectionItemData {
 
 /**
  * type guard that checks for required fields of iSetlistCollectionItemData
+ * grabrena.py leaves out the boolean flags when they are false, so these are only checked if present
  * @param {unknown} json
  * @returns {boolean} (typescript: {json is iSetlistCollectionItemData})
  */
@@ -35,8 +37,34 @@ export function typeGuardSetlistCollectionItem(json: unknown): json is iSetlistC
   }
   return !(!hasProp(json, 'title') || typeof json.title !== 'string'
     || !hasProp(json, 'url') || typeof json.url !== 'string'
-    || !hasProp(json, 'proxied') || typeof json.proxied !== 'boolean'
-    || !hasProp(json, 'free') || typeof json.free !== 'boolean');
+    || (hasProp(json, 'proxied') && typeof json.proxied !== 'boolean')
+    || (hasProp(json, 'free') && typeof json.free !== 'boolean'));
+}
+
+/**
+ * turns the facet indexes of an entry back into the values they stand for (see FacetTable in grabrena.py)
+ * @param {unknown} facets 'facets' of an entry: indexes by field name
+ * @param {unknown} facetValues the facet table: values by field name
+ * @returns {Record<string, string[]>} values by field name, fields that can't be decoded are left out
+ */
+function decodeFacets(facets: unknown, facetValues: unknown): Record<string, string[]> {
+  const result: Record<string, string[]> = {};
+  if (!isRecord(facets) || !isRecord(facetValues)) {
+    return result;
+  }
+  Object.keys(facets).forEach((field) => {
+    const indexes = facets[field];
+    const values = facetValues[field];
+    if (!Array.isArray(indexes) || !Array.isArray(values)) {
+      return;
+    }
+    const decoded = indexes.map((index) => (Number.isInteger(index) ? values[index] : undefined));
+    // XSS security: same as titles
+    if (decoded.every((value) => typeof value === 'string' && !re2.test(value))) {
+      result[field] = decoded as string[];
+    }
+  });
+  return result;
 }
 
 /**
@@ -47,8 +75,13 @@ export function typeGuardSetlistCollectionItem(json: unknown): json is iSetlistC
 export function buildElementFromCollectionItem(collectionItem: iSetlistCollectionItem): HTMLLIElement {
   const link = document.createElement('a');
   link.href = collectionItem.url;
+  const facets = collectionItem.facets ?? {};
+  const tooltip = Object.keys(facets).map((field) => facets[field].join(', '));
   if (collectionItem?.desc !== undefined) {
-    link.title = collectionItem.desc;
+    tooltip.unshift(collectionItem.desc);
+  }
+  if (tooltip.length > 0) {
+    link.title = tooltip.join('\n');
   }
   if (!collectionItem.proxied) {
     link.className = 'external';
@@ -67,9 +100,10 @@ export function buildElementFromCollectionItem(collectionItem: iSetlistCollectio
 /**
  * factory function for a SetlistCollectionItem
  * @param {iSetlistCollectionItemData|unknown} json data is type checked, {@link iSetlistCollectionItemData} format is expected
+ * @param {unknown} facetValues optional, the facet table to decode the entry's 'facets' with
  * @returns {iSetlistCollectionItem} object created from data supplied
  */
-export default function createSetlistCollectionItem(json: unknown): iSetlistCollectionItem {
+export default function createSetlistCollectionItem(json: unknown, facetValues?: unknown): iSetlistCollectionItem {
     if (!typeGuardSetlistCollectionItem(json)) {
       throw new Error('Collection contains malformed items');
     }
@@ -82,12 +116,15 @@ export default function createSetlistCollectionItem(json: unknown): iSetlistColl
     const result: iSetlistCollectionItem = {
       title: json.title,
       url: encodeV6URI(json.url),
-      proxied: json.proxied,
-      free: json.free,
+      proxied: json.proxied === true,
+      free: json.free === true,
       buildElement: buildElementFromCollectionItem,
     };
     if (typeof json?.desc === 'string' && !re2.test(json.desc)) {
       result.desc = json.desc.replace(DescRE1, '\n').replace(DescRE2, '&quot;');
     }
+    if (json?.facets !== undefined && facetValues !== undefined) {
+      result.facets = decodeFacets(json.facets, facetValues);
+    }
     return result;
 }
@@ -13,13 +13,31 @@ import { arrayFromSaneData } from './index';
  */
 const re1 = new RegExp('\\W');
 const re2 = new RegExp('[<>]'); // no script tags allowed
+const re3 = new RegExp('[^\\w.]'); // file names: word chars and dots only
+
+/**
+ * one page of a collection that grabrena.py split alphabetically, see paginate() there.
+ * the first page has no file, its entries are the collection's own data
+ */
+export interface iCollectionPage {
+  label: string;
+  count: number;
+  file?: string;
+}
 
 export interface iSetlistItemData {
   id: string;
   name: string;
   timestamp: string;
   logo?: string;
+  version?: number;
+  base?: number;
+  file?: string;
+  resources?: string;
+  facets?: string;
+  search?: string;
   data?: Array<iSetlistCollectionItem>;
+  pages?: Array<iCollectionPage>;
   error?: Error;
 }
 export interface iSetlistItem extends iSetlistItemData {
@@ -44,6 +62,57 @@ export function typeGuardSetlistItemData(json: unknown): json is iSetlistItemDat
   return true;
 }
 
+/**
+ * factory function for a page descriptor of a paged collection
+ * @param {unknown} json page descriptor from a collection file
+ * @returns {iCollectionPage}
+ */
+export function createCollectionPage(json: unknown): iCollectionPage {
+  if (!isRecord(json)
+    || !hasProp(json, 'label') || typeof json.label !== 'string'
+    || !hasProp(json, 'count') || !Number.isInteger(json.count)
+  ) {
+    throw new TypeError('CollectionPage candidate contained malformed items');
+  }
+  if (re2.test(json.label)) {
+    throw new Error('Collection contains script tags in page labels');
+  }
+  const result: iCollectionPage = { label: json.label, count: json.count as number };
+  if (hasProp(json, 'file')) {
+    if (typeof json.file !== 'string' || re3.test(json.file)) {
+      throw new Error('Collection contains malformed page file names');
+    }
+    result.file = json.file;
+  }
+  return result;
+}
+
+/**
+ * creates the submenu of one page of a paged collection. pages other than the first are filled in
+ * when their panel is first opened, until then they only hold a placeholder
+ * @param {iSetlistItem} item the paged collection
+ * @param {iCollectionPage} page
+ * @returns {HTMLLIElement}
+ */
+function buildElementFromCollectionPage(item: iSetlistItem, page: iCollectionPage): HTMLLIElement {
+  const li = document.createElement('li');
+  const span = document.createElement('span');
+  span.appendChild(document.createTextNode(page.label));
+  li.appendChild(span);
+  const ul = document.createElement('ul');
+  if (page.file === undefined) {
+    item.data?.forEach((dataItem) => ul.appendChild(dataItem.buildElement(dataItem)));
+  } else {
+    ul.dataset.ezmenuCollection = item.id;
+    ul.dataset.ezmenuPage = page.file;
+    const placeholder = document.createElement('li');
+    placeholder.appendChild(document.createTextNode('Loading\u2026'));
+    ul.appendChild(placeholder);
+  }
+  li.appendChild(ul);
+  return li;
+}
+
 /**
  * creates DOM elements representing a SetlistItem
  * @param {iSetlistItem} item to create DOM nodes for
@@ -59,7 +128,11 @@ export function buildElementFromSetlistItem(item: iSetlistItem): HTMLLIElement {
   // NOTE: elm.appendChild(other) returns other, so the extra line for return is required
   li.appendChild(span);
   li.id = `menuAnchor_${item.id}`;
-  if (Array.isArray(item.data)) {
+  if (Array.isArray(item.pages) && Array.isArray(item.data)) {
+    const ul = document.createElement('ul');
+    item.pages.forEach((page) => ul.appendChild(buildElementFromCollectionPage(item, page)));
+    li.appendChild(ul);
+  } else if (Array.isArray(item.data)) {
     const ul = document.createElement('ul');
     item.data.forEach((dataItem) => ul.appendChild(dataItem.buildElement(dataItem)));
     li.appendChild(ul);
@@ -100,6 +173,27 @@ export default function createSetlistItem(json: iSetlistItemData|unknown): iSetl
     // re1.test, as this is going to be part of a CSS classname
     result.logo = json.logo;
   }
+  // collection versions, patch files are available for all versions after base
+  if (Number.isInteger(json?.version) && Number.isInteger(json?.base)) {
+    result.version = json.version;
+    result.base = json.base;
+  }
+  if (typeof json?.file === 'string' && !re3.test(json.file)) {
+    // XSS security: file will be used to construct URLs, same as id (plus dots for the content hash)
+    result.file = json.file;
+  }
+  if (typeof json?.resources === 'string' && !re3.test(json.resources)) {
+    // name of the resource table the collection's refs point to, used to construct URLs as well
+    result.resources = json.resources;
+  }
+  if (typeof json?.facets === 'string' && !re3.test(json.facets)) {
+    // name of the facet table the collection's entries refer to, same as above
+    result.facets = json.facets;
+  }
+  if (typeof json?.search === 'string' && !re3.test(json.search)) {
+    // name of the search index over all collections, same as above
+    result.search = json.search;
+  }
   if (Array.isArray(json?.data)) {
     try {
       result.data = arrayFromSaneData(json.data, createSetlistCollectionItem);
@@ -107,6 +201,13 @@ export default function createSetlistItem(json: iSetlistItemData|unknown): iSetl
       // console.log(`bad data: ${e.message}`);
     }
   }
+  if (Array.isArray(json?.pages)) {
+    try {
+      result.pages = arrayFromSaneData(json.pages, createCollectionPage);
+    } catch (e) {
+      // console.log(`bad pages: ${e.message}`);
+    }
+  }
   if (json?.error instanceof Error) {
     result.error = json.error;
   }
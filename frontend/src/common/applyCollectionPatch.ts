@@ -0,0 +1,65 @@
+/**
+ * @copyright Copyright 2015-2021 MPI for Research on Collective Goods
+ * @license: GPLv3+
+ */
+
+import { isRecord, hasProp } from './typeGuards';
+
+/**
+ * returns what patches use to identify entries: the url of a collection entry, or the ref itself
+ * for collections that refer to a resource table
+ * @param {unknown} entry
+ * @returns {unknown} value of entry.url or the ref, undefined if there is neither
+ */
+function keyOf(entry: unknown): unknown {
+  if (typeof entry === 'string') {
+    return entry;
+  }
+  return isRecord(entry) ? entry.url : undefined;
+}
+
+/**
+ * applies a patch file written by grabrena.py (see collection_delta() there) to a deserialized collection.
+ * patches list the urls (or refs) of removed entries, modified entries and [index, entry] pairs of added entries.
+ * works on the 'data' of a collection, or on its 'refs' if it has those instead.
+ * @param {unknown} collection deserialized collection file, or the result of an earlier call
+ * @param {unknown} patch deserialized patch file
+ * @returns {Record<PropertyKey, unknown>} the collection at the version the patch leads to
+ * @throws {TypeError} if collection or patch are malformed
+ * @throws {RangeError} if the patch does not start at the version of the collection
+ */
+export default function applyCollectionPatch(collection: unknown, patch: unknown): Record<PropertyKey, unknown> {
+  if (!isRecord(collection)) {
+    throw new TypeError('applyCollectionPatch: malformed collection');
+  }
+  const listKey = hasProp(collection, 'refs') ? 'refs' : 'data';
+  const list = collection[listKey];
+  if (!Array.isArray(list)) {
+    throw new TypeError('applyCollectionPatch: malformed collection');
+  }
+  if (!isRecord(patch)
+    || !hasProp(patch, 'from') || typeof patch.from !== 'number'
+    || !hasProp(patch, 'to') || typeof patch.to !== 'number'
+    || !hasProp(patch, 'removed') || !Array.isArray(patch.removed)
+    || !hasProp(patch, 'modified') || !Array.isArray(patch.modified)
+    || !hasProp(patch, 'added') || !Array.isArray(patch.added)
+  ) {
+    throw new TypeError('applyCollectionPatch: malformed patch');
+  }
+  if (collection.version !== patch.from) {
+    throw new RangeError(`applyCollectionPatch: patch from version ${patch.from} does not apply to version ${collection.version}`);
+  }
+  const removed = new Set(patch.removed);
+  const modified = new Map(patch.modified.map((entry) => [keyOf(entry), entry]));
+  const newList = list
+    .filter((entry) => !removed.has(keyOf(entry)))
+    .map((entry) => modified.get(keyOf(entry)) ?? entry);
+  // indexes refer to the new version, so they have to be inserted in ascending order
+  patch.added.forEach((pair) => {
+    if (!Array.isArray(pair) || pair.length !== 2 || typeof pair[0] !== 'number') {
+      throw new TypeError('applyCollectionPatch: malformed added entry in patch');
+    }
+    newList.splice(pair[0], 0, pair[1]);
+  });
+  return { ...collection, [listKey]: newList, version: patch.to };
+}
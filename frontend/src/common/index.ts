@@ -1,10 +1,11 @@
-export type { iSetlistItem, iSetlistItemData } from './SetlistItem';
+export type { iSetlistItem, iSetlistItemData, iCollectionPage } from './SetlistItem';
 export type { iSetlistCollectionItem, iSetlistCollectionItemData } from './SetlistCollectionItem';
 export { default as domReady } from './domReady';
 export { default as withTimeout } from './withTimeout';
 export { default as encodeV6URI } from './encodeV6Uri';
 export { default as arrayFromSaneData } from './arrayFromSaneData';
-export { default as createSetlistItem, buildElementFromSetlistItem, typeGuardSetlistItemData } from './SetlistItem';
+export { default as applyCollectionPatch } from './applyCollectionPatch';
+export { default as createSetlistItem, buildElementFromSetlistItem, typeGuardSetlistItemData, createCollectionPage } from './SetlistItem';
 export { default as createSetlistCollectionItem, buildElementFromCollectionItem, typeGuardSetlistCollectionItem } from './SetlistCollectionItem';
 export * from './typeGuards';
 export { default as storageAvailable } from 'storage-available';
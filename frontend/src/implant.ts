@@ -9,12 +9,14 @@
  */
 
 import {
+  applyCollectionPatch,
   arrayFromSaneData,
   createSetlistItem,
-  domReady, hasProp,
+  domReady, hasProp, isRecord,
   iSetlistItem,
   storageAvailable,
 } from './common/index';
+import { MAX_PATCH_CHAIN, MENU_PACK_THRESHOLD } from './menucfg';
 
 /** figure out once whether localStorage is available.
  * @todo it is possible that `lsAvailable === true` but localStorage is quota-limited.
@@ -119,10 +121,11 @@ function retrieve(name: string, maxAge = 0, compareDate = 0): string {
  * @param {number?} lsMaxAge items older than this many milliseconds are fetched from the web, 0 to not check (default)
  * @param {number?} compareDate if set / not 0, throw RangeError if stored data has other date set as age
  * @param {boolean?} forceRefetch fetch from the web regardless of age (default false)
+ * @param {string?} filename name of the file to fetch, without '.json' (default: id)
  * @returns {Promise<string>} hopefully the Setlist
  * @throws {TypeError|Error} from checkStatus(). consumer needs to try/catch
  */
-function getById(id:string, lsMaxAge = 0, compareDate = 0, forceRefetch = false): Promise<string> {
+function getById(id:string, lsMaxAge = 0, compareDate = 0, forceRefetch = false, filename = id): Promise<string> {
   if (!forceRefetch) {
     try {
       return Promise.resolve(retrieve(id, lsMaxAge, compareDate));
@@ -131,16 +134,299 @@ function getById(id:string, lsMaxAge = 0, compareDate = 0, forceRefetch = false)
       if (e instanceof Error) console.log(e.message);
     }
   }
-  return fetchFromWeb(`${id}.json`)
+  return fetchFromWeb(`${filename}.json`)
     .then((fromWeb) => {
         store(fromWeb, id, compareDate);
         return fromWeb;
       });
 }
 
-// we're not really listening :P
-function handleMessage(evt: MessageEvent):void {
-  console.log(evt);
+/**
+ * resource and facet tables and search indexes by file name, so each is retrieved or fetched only once. see getTable()
+ */
+const tables: Map<string, Promise<unknown>> = new Map();
+
+/**
+ * provides the content of a resource or facet table or of a search index, either from localStorage or fetched from web.
+ * only one table of each kind is kept in localStorage, its file name tells whether it is the one asked for
+ * @param {string} name file name of the table, without '.json'
+ * @param {string} kind 'resources', 'facets' or 'search', also the localStorage key
+ * @param {string} contentKey where the table file keeps its content, 'entries', 'values' or 'index'
+ * @returns {Promise<unknown>} content of the table
+ * @throws {TypeError|Error} from checkStatus(). consumer needs to try/catch
+ */
+function getTable(name: string, kind: string, contentKey: string): Promise<unknown> {
+  const known = tables.get(name);
+  if (known !== undefined) {
+    return known;
+  }
+  let table: Promise<unknown>;
+  try {
+    const stored = JSON.parse(retrieve(kind));
+    if (!isRecord(stored) || stored.file !== name) {
+      throw new RangeError(`stored ${kind} table is not ${name}`);
+    }
+    table = Promise.resolve(stored[contentKey]);
+  } catch (e) {
+    if (e instanceof Error) console.log(e.message);
+    table = fetchFromWeb(`${name}.json`)
+      .then((fromWeb) => {
+        store(fromWeb, kind);
+        return JSON.parse(fromWeb)[contentKey];
+      });
+  }
+  tables.set(name, table);
+  return table;
+}
+
+/**
+ * provides the entries of a resource table, by ref. see getTable()
+ * @param {string} name file name of the resource table, without '.json'
+ * @returns {Promise<unknown>} entries of the resource table, by ref
+ */
+function getResources(name: string): Promise<unknown> {
+  return getTable(name, 'resources', 'entries');
+}
+
+/**
+ * turns a collection that refers to a resource table into one that carries its entries in 'data',
+ * which is what the parent frame expects. other collections are passed through unchanged
+ * @param {string} collectionText serialized collection
+ * @param {iSetlistItem} item SetlistItem describing the collection
+ * @returns {Promise<string>} serialized collection with 'data'
+ * @throws {TypeError} if refs can't be resolved, plus everything from getResources()
+ */
+function resolveRefs(collectionText: string, item: iSetlistItem): Promise<string> {
+  const collection = JSON.parse(collectionText);
+  if (!isRecord(collection) || !Array.isArray(collection.refs)) {
+    return Promise.resolve(collectionText);
+  }
+  if (item.resources === undefined) {
+    return Promise.reject(new TypeError(`collection ${item.id} has refs, but no resource table`));
+  }
+  const refs = collection.refs;
+  return getResources(item.resources).then((entries) => {
+    if (!isRecord(entries)) {
+      throw new TypeError(`resource table ${item.resources} is malformed`);
+    }
+    const data = refs.map((ref) => {
+      if (typeof ref !== 'string' || !hasProp(entries, ref)) {
+        throw new TypeError(`collection ${item.id} refers to unknown entry ${ref}`);
+      }
+      return entries[ref];
+    });
+    const resolved: Record<PropertyKey, unknown> = { ...collection, data };
+    delete resolved.refs;
+    return JSON.stringify(resolved);
+  });
+}
+
+/**
+ * adds the facet table a collection's entries refer to as 'facetValues', so the parent frame can
+ * decode them (see createSetlistCollectionItem()). collections without a facet table are passed through unchanged
+ * @param {string} collectionText serialized collection, or page of one
+ * @param {iSetlistItem} item SetlistItem describing the collection
+ * @returns {Promise<string>} serialized collection with 'facetValues'
+ * @throws {TypeError|Error} from checkStatus(). consumer needs to try/catch
+ */
+function addFacetValues(collectionText: string, item: iSetlistItem): Promise<string> {
+  if (item.facets === undefined) {
+    return Promise.resolve(collectionText);
+  }
+  return getTable(item.facets, 'facets', 'values').then((facetValues) => {
+    const collection = JSON.parse(collectionText);
+    return JSON.stringify({ ...collection, facetValues });
+  });
+}
+
+/**
+ * collections that came with the menu pack, by id. covers the case of localStorage being unavailable
+ */
+const packedCollections: Map<string, string> = new Map();
+
+/**
+ * fetches menupack.json, which holds the setlist and all collections, and stores its content in localStorage
+ * (and packedCollections) as if each part had been fetched by itself
+ * @returns {Promise<string>} the setlist from the menu pack
+ * @throws {TypeError} if the menu pack is malformed, plus everything from checkStatus(). consumer needs to try/catch
+ */
+function getMenuPack(): Promise<string> {
+  return fetchFromWeb('menupack.json')
+    .then((fromWeb) => {
+      const pack = JSON.parse(fromWeb);
+      if (!isRecord(pack) || !Array.isArray(pack.setlist) || !isRecord(pack.collections)) {
+        throw new TypeError('menupack.json is malformed');
+      }
+      const setlistText = JSON.stringify(pack.setlist);
+      store(setlistText, 'setlist');
+      if (isRecord(pack.resources)) {
+        const resourcesText = JSON.stringify(pack.resources);
+        tables.set(pack.resources.file as string, Promise.resolve(pack.resources.entries));
+        store(resourcesText, 'resources');
+      }
+      if (isRecord(pack.facets)) {
+        tables.set(pack.facets.file as string, Promise.resolve(pack.facets.values));
+        store(JSON.stringify(pack.facets), 'facets');
+      }
+      arrayFromSaneData(pack.setlist, createSetlistItem).forEach((item) => {
+        const collection = pack.collections[item.id];
+        if (isRecord(collection)) {
+          const collectionText = JSON.stringify(collection);
+          packedCollections.set(item.id, collectionText);
+          store(collectionText, item.id, parseInt(item.timestamp, 10));
+        }
+      });
+      return setlistText;
+    });
+}
+
+/**
+ * checks whether localStorage holds a collection as recent as the setlist says it is
+ * @param {iSetlistItem} item SetlistItem describing the collection
+ * @returns {boolean} true if the stored collection has the timestamp of item
+ */
+function isStored(item: iSetlistItem): boolean {
+  try {
+    retrieve(item.id, 0, parseInt(item.timestamp, 10));
+    return true;
+  } catch {
+    return false;
+  }
+}
+
+/**
+ * provides the setlist. if localStorage holds no setlist, or most of the collections it lists are outdated,
+ * the menu pack is fetched, so all collections arrive with a single request instead of one request each
+ * @returns {Promise<string>} hopefully the Setlist
+ * @throws {TypeError|Error} from checkStatus(). consumer needs to try/catch
+ */
+function getSetlist(): Promise<string> {
+  try {
+    retrieve('setlist');
+  } catch {
+    // nothing stored, or no localStorage at all
+    return getMenuPack().catch((e) => {
+      if (e instanceof Error) console.log(`No menu pack, reason: ${e.message}`);
+      return getById('setlist', 3600000, 0, true);
+    });
+  }
+  return getById('setlist', 3600000).then((data) => {
+    try {
+      const items = arrayFromSaneData(JSON.parse(data), createSetlistItem);
+      const outdated = items.filter((item) => !isStored(item)).length;
+      if (outdated > 1 && outdated > items.length * MENU_PACK_THRESHOLD) {
+        return getMenuPack().catch(() => data);
+      }
+    } catch {
+      // the main code block will have to deal with this setlist
+    }
+    return data;
+  });
+}
+
+/**
+ * provides the data of a collection, either from localStorage, by patching an outdated copy from localStorage
+ * up to the version listed in the setlist, or fetched from web, using {@see getById()} and {@see applyCollectionPatch()}
+ * @param {iSetlistItem} item SetlistItem describing the collection
+ * @returns {Promise<string>} hopefully the collection
+ * @throws {TypeError|Error} from checkStatus(). consumer needs to try/catch
+ */
+function getCollection(item: iSetlistItem): Promise<string> {
+  const timestamp = parseInt(item.timestamp, 10);
+  let cached: unknown;
+  const packed = packedCollections.get(item.id);
+  if (packed !== undefined) {
+    return Promise.resolve(packed);
+  }
+  try {
+    return Promise.resolve(retrieve(item.id, 0, timestamp));
+  } catch (e) {
+    if (e instanceof Error) console.log(e.message);
+  }
+  try {
+    cached = JSON.parse(retrieve(item.id));
+  } catch {
+    return getById(item.id, 0, timestamp, true, item.file);
+  }
+  const cachedVersion = isRecord(cached) ? cached.version : undefined;
+  if (item.version === undefined || item.base === undefined || typeof cachedVersion !== 'number'
+    || cachedVersion < item.base || cachedVersion >= item.version
+    || item.version - cachedVersion > MAX_PATCH_CHAIN
+  ) {
+    return getById(item.id, 0, timestamp, true, item.file);
+  }
+  const patches: Promise<string>[] = [];
+  for (let version = cachedVersion + 1; version <= item.version; version += 1) {
+    patches.push(fetchFromWeb(`${item.id}.v${version}.json`));
+  }
+  return Promise.all(patches)
+    .then((patchTexts) => {
+      const patched = JSON.stringify(patchTexts.reduce<unknown>(
+        (collection, patchText) => applyCollectionPatch(collection, JSON.parse(patchText)),
+        cached,
+      ));
+      store(patched, item.id, timestamp);
+      return patched;
+    })
+    .catch((e) => {
+      // too bad, fall back to fetching the whole thing
+      if (e instanceof Error) console.log(`Could not patch ${item.id}, reason: ${e.message}`);
+      return getById(item.id, 0, timestamp, true, item.file);
+    });
+}
+
+/**
+ * provides a page of a paged collection, either from localStorage or fetched from web.
+ * one copy of each page is kept in localStorage, the file name stored with it tells whether it is the one asked for
+ * @param {string} file file name of the page, without '.json'
+ * @param {iSetlistItem} item SetlistItem describing the collection the page belongs to
+ * @returns {Promise<string>} serialized page with 'data'
+ * @throws {TypeError|Error} from checkStatus() and resolveRefs(). consumer needs to try/catch
+ */
+function getPage(file: string, item: iSetlistItem): Promise<string> {
+  // page files are named <id>.p<n>.<hash>, the hash changes with the content, the key does not
+  const key = file.slice(0, file.lastIndexOf('.'));
+  try {
+    const stored = retrieve(key);
+    const page = JSON.parse(stored);
+    if (!isRecord(page) || page.file !== file) {
+      throw new RangeError(`stored page ${key} is not ${file}`);
+    }
+    return resolveRefs(stored, item).then((text) => addFacetValues(text, item));
+  } catch (e) {
+    if (e instanceof Error) console.log(e.message);
+  }
+  return fetchFromWeb(`${file}.json`)
+    .then((fromWeb) => {
+      store(fromWeb, key);
+      return resolveRefs(fromWeb, item);
+    })
+    .then((text) => addFacetValues(text, item));
+}
+
+/**
+ * answers the parent frame's requests for pages of paged collections. requests look like
+ * ['page', collection id, page file], answers like ['page', page file, serialized page with 'data']
+ * @param {MessageEvent} evt
+ * @param {iSetlistItem[]} setlist to look the collection up in
+ * @param {MessagePort} messagePort to answer on
+ */
+function handleMessage(evt: MessageEvent, setlist: iSetlistItem[], messagePort: MessagePort):void {
+  if (!Array.isArray(evt.data) || evt.data.length !== 3 || evt.data[0] !== 'page') {
+    console.log(evt);
+    return;
+  }
+  const [, id, file] = evt.data;
+  const item = setlist.find((value) => value.id === id);
+  // XSS security: file will be used to construct an URL, it has to be a page of the collection
+  if (item === undefined || typeof file !== 'string' || !file.startsWith(`${item.id}.p`) || /[^\w.]/.test(file)) {
+    console.log(`Ignoring request for page ${file} of ${id}`);
+    return;
+  }
+  getPage(file, item).then(
+    (text) => messagePort.postMessage(['page', file, text]),
+    (e) => console.log(`No data for page ${file}, reason: ${e.message}`),
+  );
 }
 // we're not really listening :P
 function handleMessageError(err: MessageEvent):void {
@@ -160,9 +446,9 @@ domReady().then(() => {
   window.parent.postMessage('hi', window.parent.location.origin, [messageChannel.port2]);
   // console.log('postMessage "hi"');
   // setting messagePort.onmessage implies messageChannel.start();
-  messagePort.onmessage = handleMessage;
+  messagePort.onmessage = (evt) => handleMessage(evt, setlist, messagePort);
   messagePort.onmessageerror = handleMessageError;
-  getById('setlist', 3600000)
+  getSetlist()
     .then((data) => {
       const deserialized = JSON.parse(data);
       if (Array.isArray(deserialized)) {
@@ -170,7 +456,9 @@ domReady().then(() => {
         // TODO: does this work in a non-async context?
         setlist.forEach((item) => {
           try {
-            setlistData.set(item.id, getById(item.id, 0, parseInt(item.timestamp, 10)));
+            setlistData.set(item.id, getCollection(item)
+              .then((text) => resolveRefs(text, item))
+              .then((text) => addFacetValues(text, item)));
           } catch (e) {
             // i'm not really sure which one of those two catch blocks will fire (see below)
             if (e instanceof Error) {
@@ -201,6 +489,16 @@ domReady().then(() => {
           }
         }
       });
+      // the search index is not needed to build the menu, so it waits for the collections
+      const searchName = setlist[0]?.search;
+      if (searchName !== undefined) {
+        Promise.all(Array.from(setlistData.values()).map((value) => value.catch(() => '')))
+          .then(() => getTable(searchName, 'search', 'index'))
+          .then(
+            (index) => messagePort.postMessage(['search', searchName, JSON.stringify(index)]),
+            (e) => console.log(`No search index ${searchName}, reason: ${e.message}`),
+          );
+      }
     }).catch(console.warn);
   // TODO: unload everything?
 }).catch(err => hasProp(err,  'message') ?
@@ -15,14 +15,17 @@ import '../sass/loggedin/menu.sass';
 
 import {
   arrayFromSaneData,
+  createCollectionPage,
   createSetlistCollectionItem,
   createSetlistItem,
   domReady, hasProp,
+  iSetlistCollectionItem,
   iSetlistItem,
   storageAvailable,
 } from './common/index';
 
 import registerEzJumpHandlers from "./ezjump";
+import querySearchIndex, { createSearchIndex, iSearchIndex, searchTerms } from './search';
 
 /* @ts-ignore */ // we don't have a .d.ts for Mmenu
 import Mmenu from 'mmenu-js';
@@ -37,10 +40,31 @@ import {
   MENU_UL_ID,
   MMENU_CONFIGURATION,
   MMENU_OPTIONS,
+  SEARCH_MAX_RESULTS,
+  SEARCH_RESULTS_ID,
 } from './menucfg';
 
 const lsAvailable = storageAvailable('localStorage');
 let setlist: iSetlistItem[] = [];
+// the port to the iFrame, kept to request pages of paged collections
+let implantPort: MessagePort | null = null;
+// entries of the pages of paged collections that have been filled in, by page file
+const pageEntries: Map<string, iSetlistCollectionItem[]> = new Map();
+// the search index sent over by the iFrame, until then the searchfield looks through the entries at hand
+let searchIndex: iSearchIndex | null = null;
+// the <ul> the searchfield shows its results in, and what they are results for
+let searchResults: HTMLUListElement | null = null;
+let searchQuery = '';
+
+/**
+ * the parts of the Mmenu API used to fill in pages of paged collections and search results
+ */
+interface MmenuApi {
+  bind(event: string, handler: (panel: HTMLElement) => void): void;
+  initListview(listview: HTMLElement): void;
+  openPanel(panel: HTMLElement): void;
+}
+let menuApi: MmenuApi | null = null;
 
 /**
  * creates a nav element and adds an ul/li representation of the menu data structure into it
@@ -53,6 +77,16 @@ function buildMenuDOM(sl: iSetlistItem[]): HTMLElement {
   const ul = document.createElement('ul');
   ul.id = MENU_UL_ID;
   sl.forEach((item) => ul.appendChild(item.buildElement(item)));
+  // a hidden item, so that mmenu makes a panel for the search results
+  const resultsItem = document.createElement('li');
+  resultsItem.setAttribute('style', 'display:none;');
+  const resultsTitle = document.createElement('span');
+  resultsTitle.textContent = 'Search results';
+  searchResults = document.createElement('ul');
+  searchResults.id = SEARCH_RESULTS_ID;
+  resultsItem.appendChild(resultsTitle);
+  resultsItem.appendChild(searchResults);
+  ul.appendChild(resultsItem);
   navigation.appendChild(ul);
   return navigation;
 }
@@ -89,6 +123,158 @@ function goAwayHandler(event: MouseEvent): false {
   return false;
 }
 
+/**
+ * finds the <ul> holding a page of a paged collection
+ * @param file the page file, see SetlistItem.iCollectionPage
+ */
+function pageList(file: string): HTMLUListElement | undefined {
+  const ul = Array.from(document.querySelectorAll('ul[data-ezmenu-page]'))
+    .find((candidate) => candidate instanceof HTMLUListElement && candidate.dataset.ezmenuPage === file);
+  return ul instanceof HTMLUListElement ? ul : undefined;
+}
+
+/**
+ * asks the iFrame for a page of a paged collection, unless that already happened
+ * @param ul the <ul> holding the page
+ */
+function requestPageList(ul: HTMLUListElement): void {
+  if (ul.dataset.ezmenuRequested !== undefined || implantPort === null) return;
+  ul.dataset.ezmenuRequested = '1';
+  implantPort.postMessage(['page', ul.dataset.ezmenuCollection, ul.dataset.ezmenuPage]);
+}
+
+/**
+ * asks the iFrame for the page of a paged collection whose panel is being opened, unless that already happened
+ * @param panel the panel being opened
+ */
+function requestPage(panel: HTMLElement): void {
+  const ul = panel.querySelector('ul[data-ezmenu-page]');
+  if (ul instanceof HTMLUListElement) requestPageList(ul);
+}
+
+/**
+ * the entry at a position of a collection, counting across pages for paged collections.
+ * entries of pages that have not been filled in yet are requested and missing for now
+ * @param item the collection
+ * @param position as in the search index, see querySearchIndex()
+ */
+function entryAt(item: iSetlistItem, position: number): iSetlistCollectionItem | undefined {
+  if (item.pages === undefined) return item.data?.[position];
+  let offset = 0;
+  for (const page of item.pages) {
+    if (position < offset + page.count) {
+      // the first page has no file, its entries are the collection's own data
+      if (page.file === undefined) return item.data?.[position - offset];
+      const entries = pageEntries.get(page.file);
+      if (entries === undefined) {
+        const ul = pageList(page.file);
+        if (ul !== undefined) requestPageList(ul);
+      }
+      return entries?.[position - offset];
+    }
+    offset += page.count;
+  }
+  return undefined;
+}
+
+/**
+ * the entries whose titles have all terms of query, looked for in the entries at hand.
+ * stands in for the search index until the iFrame has sent it over, or if there is none
+ * @param query what the user typed
+ */
+function scanEntries(query: string): iSetlistCollectionItem[] {
+  const queryTerms = searchTerms(query);
+  const found: iSetlistCollectionItem[] = [];
+  const scan = (entries: iSetlistCollectionItem[]) => entries.forEach((entry) => {
+    const terms = searchTerms(entry.title);
+    if (queryTerms.every((queryTerm) => terms.some((term) => (queryTerm.length >= 3
+      ? term.indexOf(queryTerm) >= 0 : term.startsWith(queryTerm))))) {
+      found.push(entry);
+    }
+  });
+  setlist.forEach((item) => scan(item.data ?? []));
+  pageEntries.forEach(scan);
+  return found;
+}
+
+/**
+ * fills the search results panel with the entries found for query, each entry once
+ * @param query what the user typed
+ */
+function fillSearchResults(query: string): void {
+  if (searchResults === null) return;
+  const ul = searchResults;
+  let found: Array<iSetlistCollectionItem | undefined>;
+  if (searchIndex === null) {
+    found = scanEntries(query);
+  } else {
+    const byId = new Map(setlist.map((item) => [item.id, item]));
+    found = querySearchIndex(searchIndex, query).map(([id, position]) => {
+      const item = byId.get(id);
+      return item === undefined ? undefined : entryAt(item, position);
+    });
+  }
+  const urls: Set<string> = new Set();
+  while (ul.firstChild !== null) ul.removeChild(ul.firstChild);
+  for (const entry of found) {
+    if (urls.size >= SEARCH_MAX_RESULTS) break;
+    if (entry !== undefined && !urls.has(entry.url)) {
+      urls.add(entry.url);
+      ul.appendChild(entry.buildElement(entry));
+    }
+  }
+  if (urls.size === 0) {
+    const li = document.createElement('li');
+    const span = document.createElement('span');
+    span.textContent = 'No results';
+    li.appendChild(span);
+    ul.appendChild(li);
+  }
+  menuApi?.initListview(ul);
+}
+
+/**
+ * shows the search results for query, or goes back to the main menu once the searchfield is cleared
+ * @param query what the user typed
+ */
+function runSearch(query: string): void {
+  searchQuery = query.trim();
+  const panel = searchQuery === ''
+    ? document.getElementById(MENU_UL_ID)?.closest('.mm-panel')
+    : searchResults?.closest('.mm-panel');
+  if (searchQuery !== '') fillSearchResults(searchQuery);
+  if (panel instanceof HTMLElement) menuApi?.openPanel(panel);
+}
+
+/**
+ * replaces the placeholder of a page of a paged collection with the entries the iFrame sent over
+ * @param file the page file, see SetlistItem.iCollectionPage
+ * @param text the serialized page
+ */
+function fillPage(file: string, text: string): void {
+  const ul = pageList(file);
+  if (ul === undefined) return;
+  const deserialized = JSON.parse(text);
+  try {
+    const items = arrayFromSaneData(
+      deserialized.data,
+      (entry) => createSetlistCollectionItem(entry, deserialized.facetValues),
+    );
+    while (ul.firstChild !== null) ul.removeChild(ul.firstChild);
+    items.forEach((item) => ul.appendChild(item.buildElement(item)));
+    pageEntries.set(file, items);
+  } catch (e) {
+    if (e instanceof TypeError) {
+      console.log(`Page ${file} deserialized to 0 items length`);
+      console.log(e.message);
+    }
+    return;
+  }
+  menuApi?.initListview(ul);
+  // search results may have been waiting for this page
+  if (searchQuery !== '') fillSearchResults(searchQuery);
+}
+
 /**
  * calls new Mmenu(elm, MMENU_OPTIONS, MMENU_CONFIGURATION)
  * @param elm the nav element housing an ul/li structure that Mmenu understands
@@ -102,6 +288,18 @@ function initializeMenu(elm: HTMLElement, event?: MouseEvent): unknown {
   }
   // in any case, build the menu
   const menu = new Mmenu(elm, MMENU_OPTIONS, MMENU_CONFIGURATION);
+  // pages of paged collections are only filled in once their panel is opened
+  menuApi = menu.API as MmenuApi;
+  menuApi.bind('openPanel:start', requestPage);
+  // the searchfield looks through all collections, see runSearch()
+  const searchInput = elm.querySelector('.mm-searchfield input');
+  if (searchInput instanceof HTMLInputElement) {
+    let timeout = 0;
+    searchInput.addEventListener('input', () => {
+      window.clearTimeout(timeout);
+      timeout = window.setTimeout(() => runSearch(searchInput.value), 200);
+    });
+  }
   // add functionality to the 'go away' button
   const goAwayLink = document.getElementById(GO_AWAY_ID);
   if (goAwayLink !== null) goAwayLink.addEventListener('click', goAwayHandler);
@@ -114,6 +312,24 @@ function initializeMenu(elm: HTMLElement, event?: MouseEvent): unknown {
  * @param event
  */
 function portListener(event: MessageEvent): void {
+  // the search index, sent after the collections (see runSearch())
+  if (Array.isArray(event.data) && event.data.length === 3 && event.data[0] === 'search') {
+    if (typeof event.data[2] === 'string') {
+      try {
+        searchIndex = createSearchIndex(JSON.parse(event.data[2]));
+      } catch (e) {
+        if (e instanceof Error) console.log(`Search index ${event.data[1]}: ${e.message}`);
+      }
+    }
+    return;
+  }
+  // pages of paged collections, sent on request (see requestPage())
+  if (Array.isArray(event.data) && event.data.length === 3 && event.data[0] === 'page') {
+    if (typeof event.data[1] === 'string' && typeof event.data[2] === 'string') {
+      fillPage(event.data[1], event.data[2]);
+    }
+    return;
+  }
   // basic sanity check for received data
   if (Array.isArray(event.data) && event.data.length === 2) {
     // console.log(`received postMessage: ${event.data[0]}`);
@@ -138,7 +354,10 @@ function portListener(event: MessageEvent): void {
         const deserialized = JSON.parse(event.data[1]);
         if (deserialized.data !== undefined && Array.isArray(deserialized.data)) {
           try {
-            setlist[found].data = arrayFromSaneData(deserialized.data, createSetlistCollectionItem);
+            setlist[found].data = arrayFromSaneData(
+              deserialized.data,
+              (entry) => createSetlistCollectionItem(entry, deserialized.facetValues),
+            );
           } catch (e) {
             if (e instanceof TypeError) {
               console.log(`Collection ${setlist[found].name} (${setlist[found].id}) deserialized to 0 items length`);
@@ -146,6 +365,13 @@ function portListener(event: MessageEvent): void {
             }
           }
         }
+        if (Array.isArray(deserialized.pages)) {
+          try {
+            setlist[found].pages = arrayFromSaneData(deserialized.pages, createCollectionPage);
+          } catch (e) {
+            if (e instanceof Error) console.log(e.message);
+          }
+        }
       }
       // after handling a received collection is finished, check if we still expect more messages
       // TODO: shouldn't this be value.?data ??
@@ -195,6 +421,7 @@ function portGrabber(event: MessageEvent): void {
   if (event.ports[0] instanceof MessagePort) {
     const messagePort: MessagePort = event.ports[0];
     messagePort.onmessage = portListener;
+    implantPort = messagePort;
     // console.log('portListener installed');
     event.preventDefault();
     // deregister self as event listener. we have what we came for
@@ -16,6 +16,10 @@ export const BASE_URL = `${BASE_ORIGIN}/`;
 // ~~~~~~~~~~~~~~~~ MENU LIB ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 export const IMPLANT_URL = `${BASE_URL}loggedin/implant.htm`;
+// collections in localStorage more than this many versions behind are fetched in full instead of being patched
+export const MAX_PATCH_CHAIN = 5;
+// fetch menupack.json (setlist plus all collections) instead of single collections if more than this share is outdated
+export const MENU_PACK_THRESHOLD = 0.5;
 
 // CSS ID of the main menu <ul>
 export const MENU_UL_ID = 'go-librecommended';
@@ -23,6 +27,10 @@ export const MENU_UL_ID = 'go-librecommended';
 export const MENU_NAV_ID = 'ezmenu-menu';
 // CSS ID of the button that unhides the menu
 export const MENU_BUTTON_ID = 'ezmenu-button';
+// CSS ID of the <ul> the searchfield shows its results in
+export const SEARCH_RESULTS_ID = 'ezmenu-search-results';
+// the searchfield shows no more than this many results
+export const SEARCH_MAX_RESULTS = 50;
 
 // HTML added to the DOM in case fetching setlist.json fails
 // TODO(krugar): make this pretty
@@ -73,7 +81,9 @@ export const MMENU_OPTIONS = {
   // searchfield must be present to set the placeholder text
   searchfield: {
     add: false, // we add this manually as a navbar
-    placeholder: 'Filter the Menu',
+    placeholder: 'Search the Menu',
+    // queries are answered from the search index written by grabrena.py instead, see runSearch() in index.ts
+    search: false,
   },
   // edit this to change the "title bar" of the menu
   navbar: {
@@ -0,0 +1,129 @@
+/**
+ * search.ts - answers queries from the search index grabrena.py writes (see update_search_index() there)
+ * a part of EZMenu
+ * @copyright Copyright 2015-2021 MPI for Research on Collective Goods
+ * @license GPLv3+
+ */
+
+import { isRecord, hasProp } from './common/index';
+
+/**
+ * these are used to fold text the way search_terms() in grabrena.py does
+ * (built with new RegExp(), unicode property escapes are not in our typescript target)
+ */
+const marksRE = new RegExp('\\p{M}', 'gu');
+const termRE = new RegExp('[\\p{L}\\p{N}]+', 'gu');
+
+export interface iSearchIndex {
+  collections: string[];
+  terms: string[];
+  postings: number[][];
+  trigrams: Record<string, number[]>;
+}
+
+/**
+ * type checks a deserialized search index
+ * @param {unknown} json the 'index' of a search.<hash>.json file
+ * @returns {iSearchIndex}
+ * @throws {TypeError} if json is malformed
+ */
+export function createSearchIndex(json: unknown): iSearchIndex {
+  if (!isRecord(json)
+    || !hasProp(json, 'collections') || !Array.isArray(json.collections)
+    || !hasProp(json, 'terms') || !Array.isArray(json.terms)
+    || !hasProp(json, 'postings') || !Array.isArray(json.postings)
+    || json.postings.length !== json.terms.length
+    || !hasProp(json, 'trigrams') || !isRecord(json.trigrams)
+  ) {
+    throw new TypeError('search index is malformed');
+  }
+  return {
+    collections: json.collections as string[],
+    terms: json.terms as string[],
+    postings: json.postings as number[][],
+    trigrams: json.trigrams as Record<string, number[]>,
+  };
+}
+
+/**
+ * the terms of text: without diacritics, in lower case, letters and digits only
+ * @param {string} text
+ * @returns {string[]}
+ */
+export function searchTerms(text: string): string[] {
+  return text.normalize('NFKD').replace(marksRE, '').toLowerCase().match(termRE) ?? [];
+}
+
+/**
+ * indexes of the terms that start with prefix. terms are sorted, so these are a contiguous range
+ * @param {iSearchIndex} index
+ * @param {string} prefix
+ * @returns {number[]}
+ */
+function termsWithPrefix(index: iSearchIndex, prefix: string): number[] {
+  let low = 0;
+  let high = index.terms.length;
+  while (low < high) {
+    const middle = Math.floor((low + high) / 2);
+    if (index.terms[middle] < prefix) {
+      low = middle + 1;
+    } else {
+      high = middle;
+    }
+  }
+  const result: number[] = [];
+  for (let termIndex = low; termIndex < index.terms.length && index.terms[termIndex].startsWith(prefix);
+    termIndex += 1) {
+    result.push(termIndex);
+  }
+  return result;
+}
+
+/**
+ * indexes of the terms that contain part, which needs to be at least three characters long.
+ * candidates are the terms that have all trigrams of part, which are then checked for part itself.
+ * the lists are intersected from the shortest one on, with a Set for each of the others
+ * @param {iSearchIndex} index
+ * @param {string} part
+ * @returns {number[]}
+ */
+function termsContaining(index: iSearchIndex, part: string): number[] {
+  const lists: number[][] = [];
+  for (let start = 0; start + 3 <= part.length; start += 1) {
+    const trigram = part.substr(start, 3);
+    lists.push(hasProp(index.trigrams, trigram) ? index.trigrams[trigram] : []);
+  }
+  lists.sort((a, b) => a.length - b.length);
+  let candidates = lists[0] ?? [];
+  for (let i = 1; i < lists.length && candidates.length > 0; i += 1) {
+    const withTrigram = new Set(lists[i]);
+    candidates = candidates.filter((termIndex) => withTrigram.has(termIndex));
+  }
+  return candidates.filter((termIndex) => index.terms[termIndex].indexOf(part) >= 0);
+}
+
+/**
+ * finds the entries whose titles have all terms of query, as the start of or within one of their terms
+ * (the latter for query terms of three or more characters)
+ * @param {iSearchIndex} index
+ * @param {string} query what the user typed
+ * @returns {Array<[string, number]>} collection id and position of each entry found, by matching term
+ */
+export default function querySearchIndex(index: iSearchIndex, query: string): Array<[string, number]> {
+  let found: Map<string, [string, number]> | null = null;
+  for (const queryTerm of searchTerms(query)) {
+    const termIndexes = queryTerm.length >= 3 ? termsContaining(index, queryTerm) : termsWithPrefix(index, queryTerm);
+    const matches: Map<string, [string, number]> = new Map();
+    for (const termIndex of termIndexes) {
+      const postings = index.postings[termIndex];
+      for (let pair = 0; pair + 1 < postings.length; pair += 2) {
+        const key = `${postings[pair]}:${postings[pair + 1]}`;
+        if (found === null || found.has(key)) {
+          matches.set(key, [index.collections[postings[pair]], postings[pair + 1]]);
+        }
+      }
+    }
+    found = matches;
+  }
+  return found === null ? [] : Array.from(found.values());
+}